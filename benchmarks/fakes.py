@@ -0,0 +1,230 @@
+"""
+Local stand-ins for the Google Directions and weather.gov APIs, serving canned responses
+built from constants.test_polyline with configurable latency and error rates.
+"""
+import asyncio
+import datetime
+import json
+import random
+import threading
+import urllib.parse
+import urllib.request
+
+import numpy as np
+from aiohttp import web
+
+import src.constants as c
+from src.modules.Geometry import decode_polylines, encode_polyline, route_distances
+
+# Rough size of an NWS forecast grid cell, in degrees
+GRID_CELL_DEGREES = 0.0225
+# Highway speed used to turn step distances into durations
+SPEED_MPH = 60
+FORECAST_HOURS = 156
+
+
+class FakeUpstream:
+    """
+    Latency and error settings of one fake API
+    """
+
+    def __init__(self, latency_ms=0, jitter_ms=0, error_rate=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.calls = 0
+        self.errors = 0
+
+    async def delay_or_fail(self):
+        """
+        :return: error response to send instead, or None
+        """
+        self.calls += 1
+        latency = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if latency > 0:
+            await asyncio.sleep(latency / 1000)
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response({'status': 503, 'detail': 'Service Unavailable'}, status=503)
+        return None
+
+
+def build_route(route_fraction=1.0, densify=1, step_points=20):
+    """
+    Builds a recorded-style directions route from a prefix of constants.test_polyline
+
+    :param route_fraction: share of the test polyline to use
+    :param densify: points to interpolate per test polyline segment, real step polylines are denser
+    :param step_points: points per step
+    :return: directions result (list of routes)
+    """
+    points = decode_polylines([c.test_polyline])
+    points = points[:max(2, int(len(points) * route_fraction))]
+
+    if densify > 1:
+        fractions = np.arange(densify) / densify
+        starts, ends = points[:-1], points[1:]
+        dense = starts[:, None, :] + (ends - starts)[:, None, :] * fractions[None, :, None]
+        points = np.vstack((dense.reshape(-1, 2), points[-1:]))
+
+    steps = []
+    for start in range(0, len(points) - 1, step_points):
+        step = points[start:start + step_points + 1]
+        miles = route_distances(step)[-1]
+        steps.append({
+            'polyline': {'points': encode_polyline(step)},
+            'distance': {'value': int(miles * 1609.34)},
+            'duration': {'value': int(miles / SPEED_MPH * 3600)},
+            'start_location': {'lat': step[0, 0], 'lng': step[0, 1]},
+            'end_location': {'lat': step[-1, 0], 'lng': step[-1, 1]},
+        })
+
+    leg = {
+        'steps': steps,
+        'start_address': 'Portland, OR, USA',
+        'end_address': 'Benchmark destination',
+        'distance': {'value': sum(step['distance']['value'] for step in steps)},
+        'duration': {'value': sum(step['duration']['value'] for step in steps)},
+    }
+    return [{
+        'legs': [leg],
+        'overview_polyline': {'points': encode_polyline(points[::max(1, densify)])},
+        'summary': 'Benchmark route',
+    }]
+
+
+def build_forecast(grid_x, grid_y):
+    now = datetime.datetime.now(datetime.timezone.utc).replace(minute=0, second=0, microsecond=0)
+    periods = []
+    for hour in range(FORECAST_HOURS):
+        start = now + datetime.timedelta(hours=hour)
+        periods.append({
+            'number': hour + 1,
+            'name': '',
+            'startTime': start.isoformat(),
+            'endTime': (start + datetime.timedelta(hours=1)).isoformat(),
+            'isDaytime': 6 <= start.hour < 18,
+            'temperature': 40 + (grid_x + hour) % 40,
+            'temperatureUnit': 'F',
+            'temperatureTrend': None,
+            'probabilityOfPrecipitation': {'unitCode': 'wmoUnit:percent', 'value': (grid_y * 7 + hour * 3) % 100},
+            'windSpeed': f'{(grid_x + grid_y + hour) % 35} mph',
+            'windDirection': 'NW',
+            'icon': 'https://api.weather.gov/icons/land/day/few?size=small',
+            'shortForecast': 'Mostly Sunny',
+            'detailedForecast': '',
+        })
+    return {
+        'type': 'Feature',
+        'properties': {
+            'updated': now.isoformat(),
+            'units': 'us',
+            'generatedAt': now.isoformat(),
+            'updateTime': now.isoformat(),
+            'validTimes': f'{now.isoformat()}/P7DT12H',
+            'periods': periods,
+        },
+    }
+
+
+class FakeServers:
+    """
+    Runs the fake Directions and NWS APIs on a background thread
+
+    :param directions: FakeUpstream settings for Directions
+    :param weather: FakeUpstream settings for weather.gov
+    """
+
+    def __init__(self, directions=None, weather=None, port=0):
+        self.directions = directions or FakeUpstream()
+        self.weather = weather or FakeUpstream()
+        self.route = build_route()
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self.base_url = None
+
+    async def handle_directions(self, request):
+        error = await self.directions.delay_or_fail()
+        if error is not None:
+            return error
+
+        waypoints = [waypoint for waypoint in request.query.get('waypoints', '').split('|') if waypoint]
+        if not waypoints:
+            return web.json_response({'status': 'OK', 'routes': self.route})
+
+        # Waypoint requests get one leg per stop, timed at highway speed
+        stops = [request.query['origin']] + waypoints + [request.query['destination']]
+        coords = np.array([[float(value) for value in stop.split(',')] for stop in stops])
+        miles = np.diff(route_distances(coords))
+        legs = [{
+            'start_address': stops[i],
+            'end_address': stops[i + 1],
+            'duration': {'value': int(leg_miles / SPEED_MPH * 3600)},
+            'distance': {'value': int(leg_miles * 1609.34)},
+        } for i, leg_miles in enumerate(miles)]
+        return web.json_response({'status': 'OK', 'routes': [{'legs': legs}]})
+
+    async def handle_points(self, request):
+        error = await self.weather.delay_or_fail()
+        if error is not None:
+            return error
+
+        lat, lng = (float(value) for value in request.match_info['coords'].split(','))
+        grid_x = int((lng + 180) / GRID_CELL_DEGREES) % 1000
+        grid_y = int((lat + 90) / GRID_CELL_DEGREES) % 1000
+        return web.json_response({'properties': {
+            'gridId': 'BMK',
+            'gridX': grid_x,
+            'gridY': grid_y,
+            'forecastHourly': f'{self.base_url}/gridpoints/BMK/{grid_x},{grid_y}/forecast/hourly',
+        }}, content_type='application/geo+json')
+
+    async def handle_forecast(self, request):
+        error = await self.weather.delay_or_fail()
+        if error is not None:
+            return error
+
+        grid_x, grid_y = (int(value) for value in request.match_info['grid'].split(','))
+        return web.json_response(build_forecast(grid_x, grid_y), content_type='application/geo+json',
+                                 headers={'Expires': (datetime.datetime.now(datetime.timezone.utc)
+                                                      + datetime.timedelta(hours=1)).strftime('%a, %d %b %Y %H:%M:%S GMT')})
+
+    def start(self):
+        app = web.Application()
+        app.router.add_get('/maps/api/directions/json', self.handle_directions)
+        app.router.add_get('/points/{coords}', self.handle_points)
+        app.router.add_get('/gridpoints/{office}/{grid}/forecast/hourly', self.handle_forecast)
+
+        runner = web.AppRunner(app)
+        self.loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, '127.0.0.1', self.port)
+        self.loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f'http://127.0.0.1:{self.port}'
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def install(self):
+        """
+        Points the pipeline at the fake servers
+        """
+        import src.modules.GoogleClient as google_client
+
+        c.points_api_base_url = self.base_url + '/points/{lat},{lng}'
+        c.gridpoint_forecast_url = self.base_url + '/gridpoints/{office}/{grid_x},{grid_y}/forecast/hourly'
+        c.directions_api_base_url = (self.base_url + '/maps/api/directions/json'
+                                     '?origin={origin}&destination={destination}&waypoints={waypoints}&key={api_key}')
+        google_client._client = LocalDirectionsClient(self.base_url)
+
+
+class LocalDirectionsClient:
+    """
+    Stands in for googlemaps.Client, fetching directions from the fake server over HTTP
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def directions(self, origin, destination, **kwargs):
+        query = urllib.parse.urlencode({'origin': origin, 'destination': destination})
+        with urllib.request.urlopen(f'{self.base_url}/maps/api/directions/json?{query}') as response:
+            return json.loads(response.read())['routes']
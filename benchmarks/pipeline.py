@@ -0,0 +1,167 @@
+"""
+Offline end-to-end benchmark of the whether pipeline against local stand-ins for the
+Directions and weather.gov APIs (see fakes.py).
+
+For every route length and marker_distance it reports per-stage and end-to-end latency,
+throughput at a given concurrency and peak traced memory. Caches are cleared before every
+run unless --warm is given.
+
+    $ python benchmarks/pipeline.py --route-fractions 0.25 0.5 1 --marker-distances 10 50
+    $ python benchmarks/pipeline.py --weather-latency 150 --weather-jitter 100 --weather-error-rate 0.05
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import src.constants as c  # noqa: E402
+from benchmarks.fakes import FakeServers, FakeUpstream, build_route  # noqa: E402
+from src.endpoints import whether  # noqa: E402
+from src.modules.AsyncHelper import AsyncHelper  # noqa: E402
+from src.modules.DirectionsCache import get_directions_cache  # noqa: E402
+from src.modules.ForecastCache import forecast_cache  # noqa: E402
+from src.modules.GridpointIndex import gridpoint_index  # noqa: E402
+
+
+def clear_caches():
+    forecast_cache.clear()
+    gridpoint_index.clear()
+    get_directions_cache().clear()
+
+
+async def run_stages(params):
+    """
+    Runs the pipeline stages one after another, timing each
+
+    :return: dict of stage name -> seconds
+    """
+    whether_algorithm = whether.get_whether_algorithm()
+    loop = asyncio.get_running_loop()
+    timings = {}
+
+    start = time.perf_counter()
+    directions_result = await loop.run_in_executor(None, whether_algorithm.get_directions, params)
+    timings['directions'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    points = whether_algorithm.extract_polylines(directions_result)
+    timings['polylines'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    markers = whether_algorithm.get_equidistant_markers_from_polyline_points(points, int(params['marker_distance']))
+    timings['markers'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    markers = await whether.get_arrival_times(whether_algorithm, params, directions_result, markers, [])
+    timings['arrival_times'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    forecasts = await whether_algorithm.fetch_forecasts(markers)
+    timings['forecasts'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    whether_algorithm.match_weather_periods(markers, forecasts)
+    timings['periods'] = time.perf_counter() - start
+
+    return timings
+
+
+async def run_end_to_end(params, concurrency):
+    start = time.perf_counter()
+    await asyncio.gather(*[whether.whether_pipeline(params) for _ in range(concurrency)])
+    return time.perf_counter() - start
+
+
+def summarize(values):
+    values = [value * 1000 for value in values]
+    return f'p50 {statistics.median(values):8.1f} ms  max {max(values):8.1f} ms'
+
+
+def benchmark(servers, route_fraction, marker_distance, args):
+    loop = AsyncHelper.get_loop()
+    servers.route = build_route(route_fraction, densify=args.densify)
+    params = {
+        'origin': f'benchmark origin {route_fraction}',
+        'destination': 'benchmark destination',
+        'marker_distance': marker_distance,
+        'arrival_time_mode': args.arrival_time_mode,
+    }
+
+    stage_runs = []
+    end_to_end = []
+    for _ in range(args.runs):
+        if not args.warm:
+            clear_caches()
+        stage_runs.append(loop.run_until_complete(run_stages(params)))
+
+        if not args.warm:
+            clear_caches()
+        end_to_end.append(loop.run_until_complete(run_end_to_end(params, 1)))
+
+    if not args.warm:
+        clear_caches()
+    batch_seconds = loop.run_until_complete(run_end_to_end(params, args.concurrency))
+
+    if not args.warm:
+        clear_caches()
+    tracemalloc.start()
+    loop.run_until_complete(run_end_to_end(params, 1))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    markers = whether.get_whether_algorithm().get_equidistant_markers_from_polyline_points(
+        whether.get_whether_algorithm().extract_polylines(servers.route), marker_distance)
+    print(f'\nroute {route_fraction:.2f} of test polyline, marker_distance {marker_distance}, '
+          f'{len(markers)} markers')
+    for stage in stage_runs[0]:
+        print(f'  {stage:>14}: {summarize([run[stage] for run in stage_runs])}')
+    print(f'  {"end to end":>14}: {summarize(end_to_end)}')
+    print(f'  {"throughput":>14}: {args.concurrency / batch_seconds:8.1f} requests/s at concurrency {args.concurrency}')
+    print(f'  {"peak memory":>14}: {peak / 1024 / 1024:8.1f} MiB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the whether pipeline')
+    parser.add_argument('--route-fractions', type=float, nargs='+', default=[0.25, 0.5, 1.0])
+    parser.add_argument('--marker-distances', type=int, nargs='+', default=[10, c.marker_distance])
+    parser.add_argument('--densify', type=int, default=20, help='points per test polyline segment')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--warm', action='store_true', help='keep caches between runs')
+    parser.add_argument('--arrival-time-mode', default=c.arrival_time_mode, choices=['estimate', 'precise'])
+    parser.add_argument('--directions-latency', type=float, default=100, help='ms')
+    parser.add_argument('--directions-jitter', type=float, default=20, help='ms')
+    parser.add_argument('--directions-error-rate', type=float, default=0)
+    parser.add_argument('--weather-latency', type=float, default=80, help='ms')
+    parser.add_argument('--weather-jitter', type=float, default=40, help='ms')
+    parser.add_argument('--weather-error-rate', type=float, default=0)
+    args = parser.parse_args()
+
+    # Keep the learned gridpoint index away from the real one
+    gridpoint_index.path = os.path.join(tempfile.mkdtemp(), 'gridpoints.idx')
+
+    servers = FakeServers(
+        directions=FakeUpstream(args.directions_latency, args.directions_jitter, args.directions_error_rate),
+        weather=FakeUpstream(args.weather_latency, args.weather_jitter, args.weather_error_rate),
+    )
+    servers.start()
+    servers.install()
+
+    for route_fraction in args.route_fractions:
+        for marker_distance in args.marker_distances:
+            benchmark(servers, route_fraction, marker_distance, args)
+
+    print(f'\nupstream calls: directions {servers.directions.calls} ({servers.directions.errors} errors), '
+          f'weather {servers.weather.calls} ({servers.weather.errors} errors)')
+
+    AsyncHelper.get_loop().run_until_complete(AsyncHelper.close_sessions())
+
+
+if __name__ == '__main__':
+    main()
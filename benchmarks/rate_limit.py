@@ -0,0 +1,86 @@
+"""
+Checks the weather.gov rate limit against local stand-ins for the Directions and weather.gov APIs
+(see fakes.py), applying constants.rate_limits['api.weather.gov'] to the fake host.
+
+Runs constants.test_event with cold caches twice and exits non-zero if either check fails:
+  - without a deadline every marker gets its weather, however long the token queue is
+  - with deadline_ms the request returns around the deadline, markers still queued are left
+    pending rather than failing as unavailable
+
+    $ python benchmarks/rate_limit.py
+    $ python benchmarks/rate_limit.py --rate 10 --burst 20 --deadline-ms 2000
+"""
+import argparse
+import collections
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import src.constants as c  # noqa: E402
+from benchmarks.fakes import FakeServers, FakeUpstream  # noqa: E402
+from benchmarks.pipeline import clear_caches  # noqa: E402
+from src.endpoints import whether  # noqa: E402
+from src.modules import RateLimiter  # noqa: E402
+from src.modules.AsyncHelper import AsyncHelper  # noqa: E402
+from src.modules.GridpointIndex import gridpoint_index  # noqa: E402
+
+
+def run(params, host):
+    clear_caches()
+    # Start every run with a full bucket
+    RateLimiter._buckets.pop(host, None)
+
+    start = time.perf_counter()
+    result = AsyncHelper.get_loop().run_until_complete(whether.whether_pipeline(params))
+    elapsed = time.perf_counter() - start
+
+    statuses = collections.Counter(marker.get('weather_status') or ('ok' if 'weather_data' in marker else 'none')
+                                   for marker in result['equidistant_markers'])
+    print(f'  {elapsed:6.2f} s, {result["marker_count"]} markers: {dict(statuses)}')
+    return elapsed, statuses
+
+
+def main():
+    rate, burst = c.rate_limits['api.weather.gov']
+    parser = argparse.ArgumentParser(description='Checks the weather.gov rate limit against the fake APIs')
+    parser.add_argument('--rate', type=float, default=rate, help='requests per second')
+    parser.add_argument('--burst', type=int, default=burst)
+    parser.add_argument('--deadline-ms', type=int, default=1000)
+    parser.add_argument('--weather-latency', type=float, default=50, help='ms')
+    args = parser.parse_args()
+
+    gridpoint_index.path = os.path.join(tempfile.mkdtemp(), 'gridpoints.idx')
+    servers = FakeServers(weather=FakeUpstream(args.weather_latency))
+    servers.start()
+    servers.install()
+
+    host = servers.base_url.split('://')[1]
+    c.rate_limits = {**c.rate_limits, host: (args.rate, args.burst)}
+    params = json.loads(c.test_event)['queryStringParameters']
+    failures = []
+
+    print(f'test_event at {args.rate:g} requests/s, burst {args.burst}, no deadline')
+    _, statuses = run(params, host)
+    if set(statuses) != {'ok'}:
+        failures.append('markers without weather and no deadline')
+
+    print(f'test_event at {args.rate:g} requests/s, burst {args.burst}, deadline_ms {args.deadline_ms}')
+    elapsed, statuses = run({**params, 'deadline_ms': args.deadline_ms}, host)
+    if statuses.get('unavailable'):
+        failures.append('markers unavailable while waiting for the rate limit')
+    # Directions and the markers come before the deadline starts, allow for them
+    if elapsed > args.deadline_ms / 1000 + 1:
+        failures.append(f'took {elapsed:.2f} s with deadline_ms {args.deadline_ms}')
+
+    AsyncHelper.get_loop().run_until_complete(AsyncHelper.close_sessions())
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Measures cold start: how long importing the router takes, and how long the first and second
+requests take in a fresh process. Each run is a new interpreter so nothing is cached.
+
+Requests go to the live APIs, so they are only measured when API_KEY is set.
+
+    $ python benchmarks/startup.py --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+import router
+timings = {'import_router': time.perf_counter() - start}
+if sys.argv[1] == '1':
+    import src.constants
+    event = json.loads(src.constants.test_event)
+    for name in ('first_request', 'second_request'):
+        start = time.perf_counter()
+        router.route(event, '')
+        timings[name] = time.perf_counter() - start
+print(json.dumps(timings))
+'''
+
+
+def run_once(with_requests):
+    output = subprocess.run([sys.executable, '-c', CHILD, '1' if with_requests else '0'],
+                            cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    # The timings are the last line, in case anything else writes to stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    with_requests = bool(os.environ.get('API_KEY'))
+    if not with_requests:
+        print('API_KEY not set, only measuring imports')
+
+    runs = [run_once(with_requests) for _ in range(args.runs)]
+    for name in runs[0]:
+        values = [run[name] * 1000 for run in runs]
+        print(f'{name:>16}: median {statistics.median(values):8.1f} ms  '
+              f'min {min(values):8.1f} ms  max {max(values):8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,68 @@
+import base64
+import gzip
 import json
 
 import src.constants
-from src.endpoints import whether
 
 
 def route(event, context):
-    print("EVENT: ", event)
+    # Imported on first request so importing the router stays cheap on cold start
+    from src.endpoints import whether
+    from src.modules.AsyncHelper import AsyncHelper
+
+    from src.modules.Instrumentation import logger
+
+    logger.debug('Event: %s', event)
     # Get params
     params = event['queryStringParameters']
 
+    # Batch and departure comparison requests are answered in one piece
+    compress = accepts_gzip(event)
+    stream = str(params.get('stream', '')).lower() in ('1', 'true')
+    if stream and whether.get_pipeline(params) is whether.whether_pipeline:
+        lines = AsyncHelper.get_loop().run_until_complete(collect_lines(params))
+        return create_ndjson_response(lines, 200, compress)
+
     directions_response = whether.whether_handler(params)
-    return create_response(directions_response, 200)
+    return create_response(directions_response, 200, compress)
+
+
+def accepts_gzip(event):
+    headers = event.get('headers') or {}
+    return any(name.lower() == 'accept-encoding' and 'gzip' in value for name, value in headers.items())
+
+
+def compress_body(response, compress):
+    """
+    Gzips the response body if the client accepts it and it is at least gzip_min_bytes.
+    API Gateway sends base64 encoded bodies to the client as binary.
+    """
+    if compress and len(response['body']) >= src.constants.gzip_min_bytes:
+        response['body'] = base64.b64encode(gzip.compress(response['body'].encode())).decode()
+        response['isBase64Encoded'] = True
+        response['headers']['Content-Encoding'] = 'gzip'
+    return response
+
+
+async def ndjson_lines(params):
+    """
+    Encodes whether.whether_stream as newline-delimited JSON, one line per item
+
+    :param params: url params
+
+    :return: async iterator of str lines
+    """
+    from src.endpoints import whether
 
+    async for item in whether.whether_stream(params):
+        yield json.dumps(item) + '\n'
 
-def create_response(body='', status=400):
+
+async def collect_lines(params):
+    return [line async for line in ndjson_lines(params)]
+
+
+def create_response(body='', status=400, compress=False):
     response = {
         'statusCode': status,
         'body': json.dumps(body),
@@ -22,8 +71,23 @@ def create_response(body='', status=400):
             'Access-Control-Allow-Origin': '*',
         },
     }
-    return response
+    return compress_body(response, compress)
+
+
+def create_ndjson_response(lines, status=400, compress=False):
+    # Lambda proxy responses are buffered, the lines only stream when served by a long-running server
+    response = {
+        'statusCode': status,
+        'body': ''.join(lines),
+        'headers': {
+            'Content-Type': 'application/x-ndjson',
+            'Access-Control-Allow-Origin': '*',
+        },
+    }
+    return compress_body(response, compress)
 
 
 if __name__=='__main__':
+    import logging
+    logging.basicConfig()
     print(route(json.loads(src.constants.test_event), ''))
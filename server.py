@@ -0,0 +1,113 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+
+from aiohttp import web
+
+import src.constants as c
+import router
+from src.endpoints import whether
+from src.modules.AsyncHelper import AsyncHelper
+
+response_headers = {
+    'Access-Control-Allow-Origin': '*',
+}
+
+
+async def handle(request):
+    # Same query parameters as the Lambda's queryStringParameters
+    params = dict(request.query)
+
+    stream = params.get('stream', '').lower() in ('1', 'true')
+    if stream and whether.get_pipeline(params) is whether.whether_pipeline:
+        lines = router.ndjson_lines(params)
+        try:
+            # Get the first line before sending the headers, so failures up to and
+            # including directions are still answered with a 500
+            first = await lines.__anext__()
+
+            response = web.StreamResponse(headers=response_headers)
+            response.content_type = 'application/x-ndjson'
+            await response.prepare(request)
+            await response.write(first.encode())
+            async for line in lines:
+                await response.write(line.encode())
+            await response.write_eof()
+            return response
+        finally:
+            await lines.aclose()
+
+    result = await whether.get_pipeline(params)(params)
+    response = web.json_response(result, headers=response_headers, dumps=json.dumps)
+    # Compressed with whichever encoding the client's Accept-Encoding allows, if any
+    if len(response.body) >= c.gzip_min_bytes:
+        response.enable_compression()
+    return response
+
+
+async def close_sessions(app):
+    await AsyncHelper.close_sessions()
+
+
+def create_app():
+    app = web.Application()
+    app.router.add_get('/{tail:.*}', handle)
+    app.on_cleanup.append(close_sessions)
+    return app
+
+
+def run_worker(sock):
+    # Each worker keeps its own event loop, pooled sessions, clients and caches for its lifetime
+    web.run_app(create_app(), sock=sock, print=None)
+
+
+def serve(host=c.server_host, port=c.server_port, workers=None):
+    """
+    Serves the API from `workers` processes sharing one listening socket
+
+    :param host: interface to bind
+    :param port: port to bind
+    :param workers: number of worker processes, defaults to one per core
+    """
+    workers = workers or os.cpu_count() or 1
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(c.server_backlog)
+    sock.set_inheritable(True)
+
+    print(f'Serving on http://{host}:{port} with {workers} workers')
+    if workers == 1:
+        run_worker(sock)
+        return
+
+    processes = [multiprocessing.Process(target=run_worker, args=(sock,)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    # Stop the workers too when the parent is told to stop
+    previous_handler = signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # Restored first, so another SIGTERM can't interrupt joining the workers
+        signal.signal(signal.SIGTERM, previous_handler)
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the Whether API')
+    parser.add_argument('--host', default=c.server_host)
+    parser.add_argument('--port', type=int, default=c.server_port)
+    parser.add_argument('--workers', type=int, default=c.server_workers)
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(process)d %(levelname)s %(message)s')
+    serve(args.host, args.port, args.workers)
@@ -9,3 +9,43 @@ weather_api_base_headers = {
 directions_api_base_url = 'https://maps.googleapis.com/maps/api/directions/json?origin={origin}&destination={destination}&waypoints={waypoints}&key={api_key}'
 marker_distance = 50
 max_waypoints = 23
+max_concurrent_requests = 20
+connection_limit_per_host = 20
+keepalive_timeout = 60
+dns_cache_ttl = 300
+points_api_base_url = 'https://api.weather.gov/points/{lat},{lng}'
+forecast_cache_max_bytes = 32 * 1024 * 1024
+forecast_refresh_interval = 60 * 60
+gridpoint_forecast_url = 'https://api.weather.gov/gridpoints/{office}/{grid_x},{grid_y}/forecast/hourly'
+gridpoint_index_path = '/tmp/whether_gridpoints.idx'
+gridpoint_index_precision = 0.01
+gridpoint_index_max_entries = 1000000
+arrival_time_mode = 'estimate'
+directions_cache_backend = 'memory'
+directions_cache_path = '/tmp/whether_directions.sqlite'
+directions_cache_bucket = 15 * 60
+directions_cache_max_entries = 256
+request_timeout = 10
+request_retries = 2
+retry_backoff = 0.25
+retry_backoff_max = 5
+hedge_requests = False
+hedge_percentile = 95
+hedge_min_samples = 20
+hedge_window = 200
+deadline_ms = None
+server_host = '0.0.0.0'
+server_port = 8080
+server_workers = None
+server_backlog = 128
+log_level = 'INFO'
+metrics_sample_rate = 1.0
+max_batch_routes = 500
+max_departures = 48
+marker_placement = 'distance'
+marker_interval = 45
+grid_cell_degrees = 0.0225
+period_fields = None
+marker_encoding = 'json'
+gzip_min_bytes = 8 * 1024
+rate_limits = {'api.weather.gov': (50, 100)}
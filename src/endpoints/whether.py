@@ -1,34 +1,392 @@
+import asyncio
+import contextvars
+import datetime
+import functools
+import json
+
+import numpy as np
+
 import src.constants as c
+from src.modules import Instrumentation
+from src.modules.AsyncHelper import AsyncHelper
+from src.modules.Geometry import encode_polyline
+from src.modules.Instrumentation import logger, span, timed
 from src.modules.WhetherAlgorithm import WhetherAlgorithm
 
+# Reused while the container stays warm
+_whether_algorithm = None
+
+
+def get_whether_algorithm():
+    global _whether_algorithm
+    if _whether_algorithm is None:
+        _whether_algorithm = WhetherAlgorithm()
+    return _whether_algorithm
+
 
 def whether_handler(params):
-    # Instantiate the algorithm class
-    whether_algorithm = WhetherAlgorithm()
+    return AsyncHelper.get_loop().run_until_complete(get_pipeline(params)(params))
+
+
+def get_pipeline(params):
+    # A 'routes' param asks for many routes in one request, 'departure_offsets' compares departure times
+    if 'routes' in params:
+        return batch_pipeline
+    if 'departure_offsets' in params:
+        return departures_pipeline
+    return whether_pipeline
+
+
+def get_deadline(params):
+    """
+    Event loop time the request's latency budget runs out at
+
+    :param params: url params, with an optional deadline_ms
+
+    :return: loop time, or None without a budget
+    """
+    deadline_ms = params.get('deadline_ms', c.deadline_ms)
+    if deadline_ms is None:
+        return None
+    return asyncio.get_running_loop().time() + int(deadline_ms) / 1000
+
+
+async def get_route_markers(whether_algorithm, params):
+    loop = asyncio.get_running_loop()
 
     # Get directions from url params
-    directions_result = whether_algorithm.get_directions(params)
+    # The googlemaps client is synchronous, so keep it off the event loop
+    # Run it in a copy of this context so it still reports to the request's metrics
+    get_directions = functools.partial(contextvars.copy_context().run, whether_algorithm.get_directions, params)
+    with span('directions'):
+        directions_result = await loop.run_in_executor(None, get_directions)
+
+    # In 'time' mode space the markers by driving time, one per grid cell
+    if params.get('marker_placement', c.marker_placement) == 'time':
+        marker_interval = params.get('marker_interval', c.marker_interval)
+        with span('markers'):
+            equidistant_markers = whether_algorithm.get_travel_time_markers(directions_result, float(marker_interval))
+        return directions_result, equidistant_markers
 
     # Extract each polyline from each leg of the directions
     # Decode each one of these polylines to produce the points
-    all_polyline_points = whether_algorithm.extract_polylines(directions_result)
+    with span('polylines'):
+        all_polyline_points = whether_algorithm.extract_polylines(directions_result)
 
     # Get equidistant markers
     marker_distance = params.get('marker_distance', c.marker_distance)
-    equidistant_markers = whether_algorithm.get_equidistant_markers_from_polyline_points(all_polyline_points, int(marker_distance))
+    with span('markers'):
+        equidistant_markers = whether_algorithm.get_equidistant_markers_from_polyline_points(all_polyline_points, int(marker_distance))
+
+    return directions_result, equidistant_markers
+
+
+async def get_arrival_times(whether_algorithm, params, directions_result, equidistant_markers, pending_tasks):
+    # Estimate the time arrived at each marker from the directions we already have,
+    # or in 'precise' mode use the GoogleMaps Waypoints API to get the times and addresses
+    arrival_time_mode = params.get('arrival_time_mode', c.arrival_time_mode)
+    try:
+        with span('arrival_times'):
+            if arrival_time_mode == 'precise':
+                return await whether_algorithm.fetch_waypoint_directions(equidistant_markers)
+            return whether_algorithm.estimate_arrival_times(directions_result, equidistant_markers)
+    except Exception:
+        for task in pending_tasks:
+            task.cancel()
+        raise
+
+
+async def whether_pipeline(params):
+    Instrumentation.start_request()
+    try:
+        result = await run_pipeline(params)
+    except Exception:
+        Instrumentation.finish_request(error=True)
+        raise
+    Instrumentation.finish_request(markers=len(result['equidistant_markers']))
+    return result
 
-    # Use the GoogleMaps Waypoints API to get the times at arrived at each marker
-    # As well as a new set of "directions results" to supply the user
-    waypoints_results = whether_algorithm.get_waypoint_directions(equidistant_markers)
 
-    # Get the weather data at each marker
-    whether_algorithm.get_weather_at_markers(equidistant_markers)
+async def get_route_forecasts(whether_algorithm, params, deadline):
+    """
+    Gets a route's markers with their arrival times, and the forecast for each marker
+
+    :return: tuple of (directions result, markers, list of IndexedForecast or None)
+    """
+    directions_result, equidistant_markers = await get_route_markers(whether_algorithm, params)
+
+    # Start downloading the weather data at each marker, it only needs the marker coordinates
+    # Forecasts that miss the deadline are left pending or filled in from stale cache
+    forecasts_task = asyncio.ensure_future(timed('forecasts', whether_algorithm.fetch_forecasts(equidistant_markers, deadline)))
+
+    waypoints_results = await get_arrival_times(whether_algorithm, params, directions_result,
+                                                equidistant_markers, [forecasts_task])
+
+    return directions_result, waypoints_results, await forecasts_task
+
+
+async def run_pipeline(params):
+    whether_algorithm = get_whether_algorithm()
+    deadline = get_deadline(params)
+
+    directions_result, waypoints_results, forecasts = await get_route_forecasts(whether_algorithm, params, deadline)
+
+    # Pick the forecast period at each marker once arrival times are known
+    with span('periods'):
+        whether_algorithm.match_weather_periods(waypoints_results, forecasts)
 
     # Format Whether result
     result = {
         'polyline': directions_result[0]['overview_polyline']['points'],
-        'equidistant_markers': waypoints_results
+        **format_markers(waypoints_results, params)
     }
     return result
 
 
+def get_response_options(params):
+    """
+    How markers are serialized
+
+    :param params: url params, with optional 'fields', comma separated forecast period fields to return
+                   such as 'temperature,shortForecast', and 'marker_encoding', 'polyline' to send the
+                   marker coordinates as one encoded polyline instead of a lat/lng per marker
+
+    :return: tuple of (list of period fields or None for all, whether coordinates are a polyline)
+    """
+    period_fields = params.get('fields', c.period_fields)
+    if isinstance(period_fields, str):
+        period_fields = [field for field in period_fields.split(',') if field]
+    polyline = params.get('marker_encoding', c.marker_encoding) == 'polyline'
+    return period_fields, polyline
+
+
+def format_markers(markers, params):
+    """
+    Serializes markers for the response, see get_response_options
+
+    :param markers: list of Markers
+    :param params: url params
+
+    :return: dict with marker_count, equidistant_markers and markers_polyline if requested
+    """
+    period_fields, polyline = get_response_options(params)
+    with span('format'):
+        result = {'marker_count': len(markers)}
+        if polyline:
+            result['markers_polyline'] = encode_polyline([(marker.lat, marker.lng) for marker in markers])
+        result['equidistant_markers'] = [marker.to_dict(period_fields, coordinates=not polyline) for marker in markers]
+    return result
+
+
+def get_departure_offsets(params):
+    """
+    Departure times to compare, in minutes from now
+
+    :param params: url params with 'departure_offsets', either a list, comma separated minutes
+                   such as '0,30,90' or an inclusive range 'start:stop:step' such as '0:360:60'
+
+    :return: list of float minutes
+    """
+    offsets = params['departure_offsets']
+    if isinstance(offsets, str):
+        if ':' in offsets:
+            start, stop, step = (float(part) for part in offsets.split(':'))
+            if step <= 0:
+                raise ValueError('departure_offsets step must be positive')
+            offsets = np.arange(start, stop + step / 2, step).tolist()
+        else:
+            offsets = [float(offset) for offset in offsets.split(',')]
+
+    if not offsets or len(offsets) > c.max_departures:
+        raise ValueError(f'departure_offsets must have between 1 and {c.max_departures} departures')
+    return [float(offset) for offset in offsets]
+
+
+async def departures_pipeline(params):
+    Instrumentation.start_request()
+    try:
+        result = await run_departures_pipeline(params)
+    except Exception:
+        Instrumentation.finish_request(error=True)
+        raise
+    Instrumentation.finish_request(markers=len(result['equidistant_markers']), departures=len(result['departures']))
+    return result
+
+
+async def run_departures_pipeline(params):
+    """
+    Compares the weather along the route for several departure times, see get_departure_offsets.
+    Each forecast is fetched once and the periods for every departure and marker are matched together.
+
+    :param params: url params
+
+    :return: dict with a summary per departure, and the markers with their weather for the best one
+    """
+    whether_algorithm = get_whether_algorithm()
+    deadline = get_deadline(params)
+    offsets = get_departure_offsets(params)
+
+    directions_result, waypoints_results, forecasts = await get_route_forecasts(whether_algorithm, params, deadline)
+
+    now = datetime.datetime.now(datetime.timezone.utc).timestamp()
+    with span('departures'):
+        period_indexes, values = whether_algorithm.evaluate_departures(waypoints_results, forecasts, offsets, now)
+        departures = whether_algorithm.summarize_departures(offsets, now, period_indexes, values)
+        best = whether_algorithm.best_departure(departures)
+
+    # Show the weather the markers get when leaving at the best time
+    if best is not None:
+        for marker, forecast, period_index in zip(waypoints_results, forecasts, period_indexes[best].tolist()):
+            if period_index >= 0:
+                marker.weather_data = forecast.periods[period_index]
+
+    return {
+        'polyline': directions_result[0]['overview_polyline']['points'],
+        **format_markers(waypoints_results, params),
+        'departures': departures,
+        'best_departure': None if best is None else departures[best]['offset'],
+    }
+
+
+def get_batch_routes(params):
+    """
+    Params for each route of a batch request. Each route takes the request's params,
+    e.g. marker_distance, overridden by its own.
+
+    :param params: url params with 'routes', a list (or JSON encoded list) of dicts
+                   with origin and destination
+
+    :return: list of params dicts, one per route
+    """
+    routes = params['routes']
+    if isinstance(routes, str):
+        routes = json.loads(routes)
+    if len(routes) > c.max_batch_routes:
+        raise ValueError(f'A batch can have at most {c.max_batch_routes} routes')
+
+    shared = {key: value for key, value in params.items() if key != 'routes'}
+    return [{**shared, **route} for route in routes]
+
+
+async def batch_pipeline(params):
+    Instrumentation.start_request()
+    try:
+        result = await run_batch_pipeline(params)
+    except Exception:
+        Instrumentation.finish_request(error=True)
+        raise
+    Instrumentation.finish_request(routes=len(result['routes']),
+                                   markers=sum(len(route.get('equidistant_markers', ())) for route in result['routes']))
+    return result
+
+
+async def run_batch_pipeline(params):
+    """
+    Runs whether_pipeline for many routes at once. The markers of every route go through one
+    forecast fetch phase, so grid cells shared between routes (e.g. along the same highway)
+    are fetched once for the whole batch.
+
+    A route that fails, e.g. with no directions between its origin and destination,
+    gets an error instead of failing the batch.
+
+    :param params: url params, see get_batch_routes
+
+    :return: dict with a result per route, in request order
+    """
+    whether_algorithm = get_whether_algorithm()
+    deadline = get_deadline(params)
+    routes = get_batch_routes(params)
+
+    route_markers = await asyncio.gather(*[get_route_markers(whether_algorithm, route_params)
+                                           for route_params in routes], return_exceptions=True)
+    results = [None] * len(routes)
+    ok = []
+    for i, route_result in enumerate(route_markers):
+        if isinstance(route_result, Exception):
+            logger.warning('Batch route %d failed: %r', i, route_result)
+            results[i] = {'error': str(route_result) or type(route_result).__name__}
+        else:
+            ok.append(i)
+
+    # Start downloading the weather data at the markers of every route together
+    all_markers = [marker for i in ok for marker in route_markers[i][1]]
+    forecasts_task = asyncio.ensure_future(timed('forecasts', whether_algorithm.fetch_forecasts(all_markers, deadline)))
+
+    try:
+        # A route's failure mustn't cancel the fetch shared with the others, so no pending tasks are given
+        waypoints_results = await asyncio.gather(*[get_arrival_times(whether_algorithm, routes[i], *route_markers[i], [])
+                                                   for i in ok], return_exceptions=True)
+        forecasts = await forecasts_task
+    except BaseException:
+        await whether_algorithm.cancel_tasks([forecasts_task])
+        raise
+
+    # Markers are in route order, so each route's forecasts are the next len(markers) of them
+    start = 0
+    for i, markers in zip(ok, waypoints_results):
+        directions_result, equidistant_markers = route_markers[i]
+        end = start + len(equidistant_markers)
+        if isinstance(markers, Exception):
+            logger.warning('Batch route %d failed: %r', i, markers)
+            results[i] = {'error': str(markers) or type(markers).__name__}
+        else:
+            with span('periods'):
+                whether_algorithm.match_weather_periods(markers, forecasts[start:end])
+            results[i] = {
+                'polyline': directions_result[0]['overview_polyline']['points'],
+                **format_markers(markers, routes[i]),
+            }
+        start = end
+
+    return {'routes': results}
+
+
+async def whether_stream(params):
+    """
+    Streaming variant of whether_pipeline. Yields the route polyline first, then each marker
+    with its weather as soon as its forecast resolves, in whichever order they arrive.
+
+    :param params: url params
+
+    :return: async iterator of result dicts
+    """
+    Instrumentation.start_request()
+    whether_algorithm = get_whether_algorithm()
+    equidistant_markers = []
+    cell_tasks = {}
+    forecast_tasks = []
+    error = False
+
+    try:
+        deadline = get_deadline(params)
+        directions_result, equidistant_markers = await get_route_markers(whether_algorithm, params)
+        period_fields, polyline = get_response_options(params)
+        forecast_tasks = whether_algorithm.create_forecast_tasks(equidistant_markers, cell_tasks)
+
+        first = {
+            'polyline': directions_result[0]['overview_polyline']['points'],
+            'marker_count': len(equidistant_markers),
+        }
+        if polyline:
+            first['markers_polyline'] = encode_polyline([(marker.lat, marker.lng) for marker in equidistant_markers])
+        yield first
+
+        waypoints_results = await get_arrival_times(whether_algorithm, params, directions_result,
+                                                    equidistant_markers, forecast_tasks)
+
+        now = datetime.datetime.now(datetime.timezone.utc).timestamp()
+        forecasts = whether_algorithm.iter_forecasts(equidistant_markers, forecast_tasks, cell_tasks, deadline)
+        async for i, forecast in forecasts:
+            marker = waypoints_results[i]
+            whether_algorithm.match_weather_period(marker, forecast, now)
+            yield {'index': i, 'marker': marker.to_dict(period_fields, coordinates=not polyline)}
+    except Exception:
+        error = True
+        raise
+    finally:
+        # The client may stop reading early
+        await whether_algorithm.cancel_tasks(forecast_tasks + list(cell_tasks.values()))
+        if error:
+            Instrumentation.finish_request(error=True, stream=True)
+        else:
+            Instrumentation.finish_request(markers=len(equidistant_markers), stream=True)
@@ -1,29 +1,266 @@
 import asyncio
+import json
+import logging
+import random
+from collections import deque
+from urllib.parse import urlsplit
 
-import aiohttp
+import src.constants as c
+from src.modules.Instrumentation import count, span
+from src.modules.RateLimiter import get_rate_limiter
+
+# Kept at module level so warm Lambda invocations reuse the loop and its open connections
+_loop = None
+_sessions = {}
+_semaphores = {}
+# Recent latencies per host, used to decide when to hedge
+_latencies = {}
+# In-flight fetches by (loop, url, request settings), shared by concurrent callers
+_flights = {}
+
+logger = logging.getLogger(__name__)
+
+
+class RetryableStatus(Exception):
+    """
+    Raised for responses worth retrying (429 and 5xx)
+    """
+
+    def __init__(self, status, retry_after=None, paused=False):
+        super().__init__(f'upstream returned {status}')
+        self.status = status
+        self.retry_after = retry_after
+        # Retry-After was already applied to the host's rate limiter
+        self.paused = paused
+
+
+def retryable_errors():
+    """
+    Errors worth retrying. aiohttp is imported on first use, fully cached requests never need it.
+
+    :return: tuple of exception types
+    """
+    import aiohttp
+    return RetryableStatus, aiohttp.ClientError, asyncio.TimeoutError
 
 
 class AsyncHelper:
 
-    def __init__(self, url_id_list, headers):
+    def __init__(self, url_id_list, headers, concurrency=None, include_meta=False,
+                 timeout=None, retries=None, hedge=None):
         self.url_id_list = url_id_list
         self.headers = headers
+        self.concurrency = concurrency or c.max_concurrent_requests
+        # When set, get_one also returns the response size and Expires header
+        self.include_meta = include_meta
+        self.timeout = timeout or c.request_timeout
+        self.retries = c.request_retries if retries is None else retries
+        # Send a duplicate request once a call outlasts hedge_percentile of recent latencies
+        self.hedge = c.hedge_requests if hedge is None else hedge
+
+    @staticmethod
+    def get_loop():
+        """
+        Returns the event loop shared across invocations, creating it if needed
+
+        :return: asyncio event loop
+        """
+        global _loop
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(_loop)
+        return _loop
+
+    @staticmethod
+    def get_session(url):
+        """
+        Returns the pooled session for the url's host on the running loop.
+        Must be called from within a coroutine.
+
+        :param url: url that will be requested with the session
+
+        :return: aiohttp.ClientSession
+        """
+        key = (asyncio.get_running_loop(), urlsplit(url).netloc)
+        session = _sessions.get(key)
+        if session is None or session.closed:
+            import aiohttp
+            connector = aiohttp.TCPConnector(ssl=False,
+                                             limit_per_host=c.connection_limit_per_host,
+                                             keepalive_timeout=c.keepalive_timeout,
+                                             ttl_dns_cache=c.dns_cache_ttl)
+            session = aiohttp.ClientSession(connector=connector)
+            _sessions[key] = session
+        return session
+
+    @staticmethod
+    async def close_sessions():
+        """
+        Closes every pooled session owned by the running loop
+        """
+        loop = asyncio.get_running_loop()
+        for key in [key for key in _sessions if key[0] is loop]:
+            await _sessions.pop(key).close()
+
+    def get_semaphore(self):
+        key = (asyncio.get_running_loop(), self.concurrency)
+        semaphore = _semaphores.get(key)
+        if semaphore is None:
+            semaphore = _semaphores[key] = asyncio.Semaphore(self.concurrency)
+        return semaphore
+
+    @staticmethod
+    def get_hedge_delay(host):
+        """
+        Latency past which a call to host gets hedged, or None until there are enough samples
+
+        :param host: url host
+
+        :return: seconds or None
+        """
+        latencies = _latencies.get(host)
+        if latencies is None or len(latencies) < c.hedge_min_samples:
+            return None
+        ordered = sorted(latencies)
+        return ordered[min(len(ordered) - 1, len(ordered) * c.hedge_percentile // 100)]
+
+    async def request(self, session, url, limited=True):
+        import aiohttp
+
+        loop = asyncio.get_running_loop()
+        host = urlsplit(url).netloc
+        limiter = get_rate_limiter(host)
+        # Wait for a token before taking a concurrency slot, the slots are shared with other hosts
+        if limited and limiter is not None:
+            await limiter.acquire()
+        async with self.get_semaphore():
+            start = loop.time()
+            count('upstream_calls')
+            with span(f'upstream {host}'):
+                async with session.get(url, headers=self.headers,
+                                       timeout=aiohttp.ClientTimeout(total=self.timeout)) as response:
+                    body = await response.read()
+                    count('upstream_bytes', len(body))
+                    if response.status == 429 or response.status >= 500:
+                        count('upstream_errors')
+                        retry_after = response.headers.get('Retry-After')
+                        # Being throttled, hold back every request to the host rather than just this one
+                        paused = response.status == 429 and limiter is not None and bool(retry_after) and retry_after.isdigit()
+                        if paused:
+                            limiter.pause(int(retry_after))
+                        raise RetryableStatus(response.status, retry_after, paused)
+                    meta = {
+                        'size': len(body),
+                        'expires': response.headers.get('Expires'),
+                    }
+
+        _latencies.setdefault(host, deque(maxlen=c.hedge_window)).append(loop.time() - start)
+        return json.loads(body), meta
 
     async def get_response(self, session, url):
-        async with session.get(url) as response:
-            data = await response.json()
-        return data
+        host = urlsplit(url).netloc
+        # Queue for the token first, so time spent in line doesn't count towards the hedge delay
+        limiter = get_rate_limiter(host)
+        if limiter is not None:
+            await limiter.acquire()
+
+        hedge_delay = self.get_hedge_delay(host) if self.hedge else None
+        if hedge_delay is None:
+            return await self.request(session, url, limited=False)
+
+        tasks = [asyncio.ensure_future(self.request(session, url, limited=False))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+            if not done:
+                # Slower than usual, race a duplicate and keep whichever succeeds first
+                count('upstream_hedges')
+                tasks.append(asyncio.ensure_future(self.request(session, url)))
+
+            error = None
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    return await next_done
+                except retryable_errors() as e:
+                    error = e
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def get_with_retries(self, url):
+        for attempt in range(self.retries + 1):
+            try:
+                return await self.get_response(self.get_session(url), url)
+            except retryable_errors() as e:
+                if attempt == self.retries:
+                    raise
+                count('upstream_retries')
+                # Full jitter, but never sooner than the upstream asked for,
+                # unless the host's rate limiter is already holding requests back for it
+                delay = random.uniform(0, c.retry_backoff * 2 ** attempt)
+                retry_after = getattr(e, 'retry_after', None)
+                if retry_after and retry_after.isdigit() and not getattr(e, 'paused', False):
+                    delay = max(delay, int(retry_after))
+                await asyncio.sleep(min(delay, c.retry_backoff_max))
+
+    async def get_coalesced(self, url):
+        """
+        get_with_retries, but concurrent calls for the same url with the same headers, timeout, retries
+        and hedging wait on one fetch. The fetch is cancelled once every caller waiting on it has been cancelled.
+
+        :param url: url to get
+
+        :return: tuple of (data, meta)
+        """
+        key = (asyncio.get_running_loop(), url, tuple(sorted((self.headers or {}).items())),
+               self.timeout, self.retries, self.hedge)
+        flight = _flights.get(key)
+        if flight is None:
+            # [task, number of callers waiting on it]
+            flight = _flights[key] = [asyncio.ensure_future(self.get_with_retries(url)), 0]
+
+            def land(_):
+                if _flights.get(key) is flight:
+                    del _flights[key]
+            flight[0].add_done_callback(land)
+        else:
+            count('upstream_coalesced')
+
+        flight[1] += 1
+        try:
+            return await asyncio.shield(flight[0])
+        finally:
+            flight[1] -= 1
+            if not flight[1] and not flight[0].done():
+                flight[0].cancel()
 
     async def get_one(self, url_id):
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(verify_ssl=False), headers=self.headers) as session:
-            url = url_id[0]
-            marker = url_id[1]
-            data = await self.get_response(session, url)
+        url = url_id[0]
+        marker = url_id[1]
+        data, meta = await self.get_coalesced(url)
+        if self.include_meta:
+            return data, marker, meta
         return data, marker
 
+    async def get_one_or_none(self, url_id):
+        try:
+            return await self.get_one(url_id)
+        except retryable_errors() + (ValueError,) as e:
+            logger.warning('Request to %s failed: %r', url_id[0], e)
+            count('upstream_failures')
+            if self.include_meta:
+                return None, url_id[1], None
+            return None, url_id[1]
+
+    async def wait_all(self):
+        """
+        Requests every url concurrently
+
+        :return: list of (data, id) tuples in the order of url_id_list, data is None where the
+                 request failed after retries. (data, id, meta) if include_meta.
+        """
+        return await asyncio.gather(*[self.get_one_or_none(url_id) for url_id in self.url_id_list])
+
     def async_all(self):
-        loop = asyncio.get_event_loop()
-        to_do = [self.get_one(url_id) for url_id in self.url_id_list]
-        wait_coro = asyncio.wait(to_do)
-        result, _ = loop.run_until_complete(wait_coro)
-        return result
+        loop = self.get_loop()
+        return loop.run_until_complete(self.wait_all())
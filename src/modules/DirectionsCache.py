@@ -0,0 +1,152 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import src.constants as c
+from src.modules.Instrumentation import count
+from src.modules.Marker import Marker
+
+
+class MemoryBackend:
+    """
+    In-process LRU store, lost when the container is recycled
+    """
+
+    def __init__(self, max_entries=c.directions_cache_max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # key -> (value, expires_at), least recently used first
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def set(self, key, value, expires_at):
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class SqliteBackend:
+    """
+    SQLite store that survives restarts. Values are stored as JSON.
+    """
+
+    def __init__(self, path=c.directions_cache_path):
+        import sqlite3
+
+        self.lock = threading.Lock()
+        # Used from the executor thread that runs googlemaps calls
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)')
+        self.connection.commit()
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute('SELECT value, expires_at FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None or row[1] <= time.time():
+            return None
+        return json.loads(row[0])
+
+    def set(self, key, value, expires_at):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?)', (key, json.dumps(value), expires_at))
+            self.connection.execute('DELETE FROM cache WHERE expires_at <= ?', (time.time(),))
+            self.connection.commit()
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute('DELETE FROM cache')
+            self.connection.commit()
+
+
+backends = {
+    'memory': MemoryBackend,
+    'sqlite': SqliteBackend,
+}
+
+
+class DirectionsCache:
+    """
+    Caches googlemaps results by normalized query. Results are shared by every request whose
+    departure time falls in the same bucket of `bucket_seconds`.
+    """
+
+    def __init__(self, backend=None, bucket_seconds=c.directions_cache_bucket):
+        self.backend = backend or backends[c.directions_cache_backend]()
+        self.bucket_seconds = bucket_seconds
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.backend.clear()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(value):
+        if isinstance(value, dict):
+            return f'{value["lat"]},{value["lng"]}'
+        if isinstance(value, Marker):
+            return f'{value.lat},{value.lng}'
+        if isinstance(value, (list, tuple)):
+            return '|'.join(DirectionsCache.normalize(item) for item in value)
+        return ' '.join(str(value).lower().split())
+
+    def make_key(self, kind, bucket, parts):
+        return '/'.join([kind, str(bucket)] + [self.normalize(part) for part in parts])
+
+    def get_or_call(self, kind, departure_time, parts, call):
+        """
+        Returns the cached result for a query, otherwise calls `call` and caches its result
+        until the end of the departure time bucket
+
+        :param kind: name of the call being cached, e.g. 'directions'
+        :param departure_time: datetime the query is for
+        :param parts: query values, normalized for case and whitespace
+        :param call: function returning the result
+
+        :return: result
+        """
+        bucket = int(departure_time.timestamp() // self.bucket_seconds)
+        key = self.make_key(kind, bucket, parts)
+
+        result = self.backend.get(key)
+        if result is not None:
+            self.hits += 1
+            count(f'{kind}_cache_hits')
+            return result
+
+        self.misses += 1
+        count(f'{kind}_cache_misses')
+        result = call()
+        # Don't hold on to empty results such as an unroutable query
+        if result:
+            self.backend.set(key, result, (bucket + 1) * self.bucket_seconds)
+        return result
+
+
+# Shared across warm invocations, created on first use so the backend isn't opened at import
+_directions_cache = None
+
+
+def get_directions_cache():
+    global _directions_cache
+    if _directions_cache is None:
+        _directions_cache = DirectionsCache()
+    return _directions_cache
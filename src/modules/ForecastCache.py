@@ -0,0 +1,197 @@
+import datetime
+import re
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+
+import numpy as np
+
+import src.constants as c
+
+
+def parse_time(value):
+    """
+    Parses an NWS ISO 8601 timestamp, e.g. '2023-01-01T10:00:00-08:00', to epoch seconds.
+    Much faster than dateutil, which matters as every forecast has hundreds of them.
+    """
+    # fromisoformat only accepts a trailing Z from Python 3.11
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def wind_speed(period):
+    # e.g. '10 mph' or '5 to 15 mph', take the highest
+    speeds = re.findall(r'\d+', period.get('windSpeed') or '')
+    return max(map(float, speeds)) if speeds else None
+
+
+def precipitation_probability(period):
+    return (period.get('probabilityOfPrecipitation') or {}).get('value')
+
+
+# Numeric period fields IndexedForecast.get_values can parse
+period_values = {
+    'precipitation_probability': precipitation_probability,
+    'wind_speed': wind_speed,
+    'temperature': lambda period: period.get('temperature'),
+}
+
+
+class IndexedForecast:
+    """
+    NWS forecast response with its periods parsed once into sorted epoch arrays,
+    so the period covering a time can be found by binary search.
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.periods = response['properties']['periods']
+        self.starts = np.array([parse_time(period['startTime']) for period in self.periods])
+        self.ends = np.array([parse_time(period['endTime']) for period in self.periods])
+        self.values = {}
+
+    def find_periods(self, times):
+        """
+        Finds the index of the period covering each time
+
+        :param times: epoch seconds, scalar or array
+
+        :return: period indexes, -1 where no period covers the time
+        """
+        times = np.asarray(times, dtype=np.float64)
+        if not len(self.periods):
+            return np.full(times.shape, -1)
+
+        indexes = np.searchsorted(self.starts, times, side='right') - 1
+        covered = (indexes >= 0) & (times < self.ends[indexes.clip(0)])
+        return np.where(covered, indexes, -1)
+
+    def get_values(self, name):
+        """
+        Parses a numeric field of every period into an array, once per forecast
+
+        :param name: one of period_values
+
+        :return: float array in period order, nan where the period has no value
+        """
+        if name not in self.values:
+            values = [period_values[name](period) for period in self.periods]
+            self.values[name] = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+        return self.values[name]
+
+
+class ForecastCache:
+    """
+    In-process LRU cache of IndexedForecasts keyed by grid cell (office, gridX, gridY).
+
+    Size is approximated by the length of the response body each forecast was parsed from.
+    """
+
+    def __init__(self, max_bytes=c.forecast_cache_max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        # key -> (forecast, expires_at, size), least recently used first
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def grid_key(points_properties):
+        """
+        Builds the cache key from the properties of a /points response
+
+        :param points_properties: 'properties' of a /points response
+
+        :return: tuple of (office, gridX, gridY)
+        """
+        return points_properties['gridId'], points_properties['gridX'], points_properties['gridY']
+
+    @staticmethod
+    def get_expiry(forecast, expires=None):
+        """
+        Works out when a forecast goes stale. Prefers the response's Expires header,
+        otherwise assumes the next update lands forecast_refresh_interval after updateTime.
+
+        :param forecast: forecast response
+        :param expires: value of the Expires header, if any
+
+        :return: expiry as epoch seconds
+        """
+        if expires:
+            try:
+                return parsedate_to_datetime(expires).timestamp()
+            except (TypeError, ValueError):
+                pass
+
+        update_time = forecast.get('properties', {}).get('updateTime')
+        if update_time:
+            try:
+                return parse_time(update_time) + c.forecast_refresh_interval
+            except ValueError:
+                pass
+
+        return time.time() + c.forecast_refresh_interval
+
+    def get(self, key, now=None):
+        """
+        Returns the cached forecast for a grid cell, or None if missing or expired
+
+        :param key: grid cell key
+        :param now: current epoch seconds
+
+        :return: IndexedForecast or None
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        forecast, expires_at, size = entry
+        # Expired entries are kept for get_stale until they are evicted
+        if expires_at <= (now or time.time()):
+            return None
+
+        self.entries.move_to_end(key)
+        return forecast
+
+    def get_stale(self, key):
+        """
+        Returns the cached forecast for a grid cell even if it has expired
+
+        :param key: grid cell key
+
+        :return: IndexedForecast or None
+        """
+        entry = self.entries.get(key)
+        return entry[0] if entry is not None else None
+
+    def put(self, key, forecast, expires_at, size):
+        """
+        Stores a forecast, evicting the least recently used entries to stay under max_bytes
+
+        :param key: grid cell key
+        :param forecast: IndexedForecast
+        :param expires_at: expiry as epoch seconds
+        :param size: approximate size in bytes
+        """
+        if size > self.max_bytes or expires_at <= time.time():
+            return
+
+        self.remove(key)
+        self.entries[key] = (forecast, expires_at, size)
+        self.current_bytes += size
+
+        while self.current_bytes > self.max_bytes:
+            _, (_, _, evicted_size) = self.entries.popitem(last=False)
+            self.current_bytes -= evicted_size
+
+    def clear(self):
+        self.entries.clear()
+        self.current_bytes = 0
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry[2]
+
+
+# Shared across warm invocations
+forecast_cache = ForecastCache()
@@ -0,0 +1,239 @@
+import numpy as np
+
+# Earth's radius in miles
+EARTH_RADIUS = 3959
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Calculate the great circle distance between arrays of points
+    on the earth (specified in decimal degrees)
+
+    :param lat1: array of start latitudes
+    :param lon1: array of start longitudes
+    :param lat2: array of end latitudes
+    :param lon2: array of end longitudes
+    :return: array of distances in miles
+    """
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def move_towards(lat1, lon1, lat2, lon2, distance):
+    """
+    Moves from each start point towards its end point by the specified distance
+
+    :param lat1: array of start latitudes
+    :param lon1: array of start longitudes
+    :param lat2: array of end latitudes
+    :param lon2: array of end longitudes
+    :param distance: array of distances to travel, in miles
+    :return: (N, 2) array of lat/lng coordinates
+    """
+    d_lon = np.radians(lon2 - lon1)
+    lat1, lon1, lat2 = map(np.radians, (lat1, lon1, lat2))
+
+    # Find the bearing from point1 to point2
+    bearing = np.arctan2(np.sin(d_lon) * np.cos(lat2),
+                         np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(d_lon))
+
+    ang_dist = distance / EARTH_RADIUS
+
+    # Calculate the destination point, given the source and bearing
+    dest_lat = np.arcsin(np.sin(lat1) * np.cos(ang_dist) +
+                         np.cos(lat1) * np.sin(ang_dist) * np.cos(bearing))
+    dest_lon = lon1 + np.arctan2(np.sin(bearing) * np.sin(ang_dist) * np.cos(lat1),
+                                 np.cos(ang_dist) - np.sin(lat1) * np.sin(dest_lat))
+
+    return np.column_stack((np.degrees(dest_lat), np.degrees(dest_lon)))
+
+
+def route_distances(points):
+    """
+    Cumulative distance along a route at each of its points
+
+    :param points: (N, 2) float array of lat/lng
+    :return: (N,) float array of distances from the first point, in miles
+    """
+    segment_lengths = haversine(points[:-1, 0], points[:-1, 1], points[1:, 0], points[1:, 1])
+    return np.concatenate(([0.0], np.cumsum(segment_lengths)))
+
+
+def points_at_distances(points, cumulative, targets):
+    """
+    Finds the points at the given distances along a route. Binary searches the cumulative
+    distance (numpy.searchsorted) for the segment each target falls in, then travels the
+    remainder along that segment.
+
+    :param points: (N, 2) float array of lat/lng, N >= 2
+    :param cumulative: (N,) float array from route_distances(points)
+    :param targets: (M,) float array of miles from the first point
+    :return: (M, 2) float array of lat/lng
+    """
+    # segment each target lands in; side='right' never picks a zero length segment
+    segments = np.searchsorted(cumulative, targets, side='right') - 1
+    segments = np.clip(segments, 0, len(points) - 2)
+    remainders = targets - cumulative[segments]
+
+    starts = points[segments]
+    ends = points[segments + 1]
+    return move_towards(starts[:, 0], starts[:, 1], ends[:, 0], ends[:, 1], remainders)
+
+
+def equidistant_markers(points, distance, return_distances=False):
+    """
+    Given an (N, 2) array of lat/lng points along a route, returns the points that are evenly
+    spaced `distance` miles apart along it, in route order. The origin and destination are always
+    included, and the last evenly spaced point is dropped if it is within half a step of the destination.
+
+    :param points: (N, 2) float array of lat/lng
+    :param distance: distance between markers, in miles
+    :param return_distances: also return each marker's distance along the route
+    :return: (M, 2) float array of lat/lng, and (M,) float array of miles if return_distances
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) < 2:
+        if return_distances:
+            return points.copy(), np.zeros(len(points))
+        return points.copy()
+
+    cumulative = route_distances(points)
+    total = cumulative[-1]
+
+    # distance from the origin of each marker
+    targets = np.arange(distance, total, distance)
+
+    # if close enough to the destination, drop last marker
+    if len(targets) and total - targets[-1] < distance / 2:
+        targets = targets[:-1]
+
+    markers = points_at_distances(points, cumulative, targets)
+    markers = np.vstack((points[:1], markers, points[-1:]))
+
+    if return_distances:
+        return markers, np.concatenate(([0.0], targets, [total]))
+    return markers
+
+
+def travel_time_markers(points, step_ends, step_seconds, interval, return_distances=False):
+    """
+    Like equidistant_markers, but spaces the markers `interval` minutes of driving apart, so they
+    are closer together on slow stretches and further apart on fast ones. Time is assumed to pass
+    linearly with distance within each step.
+
+    :param points: (N, 2) float array of lat/lng, from decode_polylines
+    :param step_ends: index of each step's last point, from decode_polylines
+    :param step_seconds: duration of each step, in seconds
+    :param interval: driving time between markers, in minutes
+    :param return_distances: also return each marker's distance along the route
+    :return: (M, 2) float array of lat/lng, and (M,) float array of miles if return_distances
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) < 2:
+        if return_distances:
+            return points.copy(), np.zeros(len(points))
+        return points.copy()
+
+    cumulative = route_distances(points)
+    total = cumulative[-1]
+
+    # Elapsed minutes and distance at the start of the route and at the end of each step
+    step_minutes = np.concatenate(([0.0], np.cumsum(step_seconds) / 60))
+    step_distances = np.concatenate(([0.0], cumulative[step_ends]))
+
+    # time from the origin of each marker, the last is dropped if close enough to the destination
+    times = np.arange(interval, step_minutes[-1], interval)
+    if len(times) and step_minutes[-1] - times[-1] < interval / 2:
+        times = times[:-1]
+    targets = np.interp(times, step_minutes, step_distances)
+
+    markers = points_at_distances(points, cumulative, targets)
+    markers = np.vstack((points[:1], markers, points[-1:]))
+
+    if return_distances:
+        return markers, np.concatenate(([0.0], targets, [total]))
+    return markers
+
+
+def decode_polylines(encoded_polylines, return_step_ends=False):
+    """
+    Decodes consecutive encoded polylines (e.g. every step of a route) into a single array.
+    The first point of every polyline after the first is dropped, as it duplicates the
+    last point of the one before it.
+
+    Decodes all polylines at once: the characters are split into 5-bit chunks, summed into
+    zig-zag encoded deltas and cumulatively summed per polyline.
+
+    :param encoded_polylines: iterable of encoded polyline strings
+    :param return_step_ends: also return the index of each polyline's last point
+    :return: (N, 2) float array of lat/lng, and (len(encoded_polylines),) int array if return_step_ends
+    """
+    encoded_polylines = [polyline.encode() for polyline in encoded_polylines]
+    encoded = [polyline for polyline in encoded_polylines if polyline]
+    if not encoded:
+        points = np.empty((0, 2))
+        if return_step_ends:
+            return points, np.zeros(len(encoded_polylines), dtype=np.int64)
+        return points
+
+    chunks = np.frombuffer(b''.join(encoded), dtype=np.uint8).astype(np.int64) - 63
+
+    # a chunk without the continuation bit ends a value
+    value_ends = chunks < 0x20
+    value_starts = np.flatnonzero(np.concatenate(([True], value_ends[:-1])))
+    value_ids = np.cumsum(value_ends) - value_ends
+    shifts = 5 * (np.arange(len(chunks)) - value_starts[value_ids])
+    values = np.add.reduceat((chunks & 0x1f) << shifts, value_starts)
+    deltas = ((values >> 1) ^ -(values & 1)).reshape(-1, 2)
+
+    # number of points in each polyline
+    polyline_starts = np.cumsum([0] + [len(polyline) for polyline in encoded[:-1]])
+    point_counts = np.add.reduceat(value_ends, polyline_starts) // 2
+    point_starts = np.cumsum(point_counts) - point_counts
+
+    # deltas restart at every polyline, so remove the running total of the ones before it
+    totals = np.cumsum(deltas, axis=0)
+    offsets = np.vstack(([[0, 0]], totals[point_starts[1:] - 1]))
+    points = (totals - np.repeat(offsets, point_counts, axis=0)) / 1e5
+    points = np.delete(points, point_starts[1:], axis=0)
+
+    if not return_step_ends:
+        return points
+
+    # empty polylines end where the polyline before them did
+    ends = np.cumsum(point_counts - 1)
+    non_empty = np.array([bool(polyline) for polyline in encoded_polylines])
+    step_ends = np.zeros(len(encoded_polylines), dtype=np.int64)
+    step_ends[non_empty] = ends
+    step_ends = np.maximum.accumulate(step_ends)
+    return points, step_ends
+
+
+def encode_polyline(points):
+    """
+    Encodes points as a Google encoded polyline, the inverse of decode_polylines for one polyline.
+
+    Every rounded delta is zig-zag encoded and split into up to 7 5-bit chunks at once,
+    the chunks each value needs are then kept in order.
+
+    :param points: (N, 2) float array of lat/lng
+    :return: encoded polyline string
+    """
+    points = np.round(np.asarray(points, dtype=np.float64).reshape(-1, 2) * 1e5).astype(np.int64)
+    if not len(points):
+        return ''
+
+    deltas = np.diff(points, axis=0, prepend=[[0, 0]]).ravel()
+    values = (deltas << 1) ^ (deltas >> 63)
+
+    shifts = 5 * np.arange(7)
+    chunks = (values[:, None] >> shifts) & 0x1f
+    # number of chunks needed by each value, at least one
+    lengths = np.maximum(1, (np.floor(np.log2(np.maximum(values, 1))).astype(np.int64) + 5) // 5)
+    used = np.arange(7) < lengths[:, None]
+    continued = np.arange(7) < lengths[:, None] - 1
+
+    chunks = (chunks | (continued * 0x20)) + 63
+    return chunks[used].astype(np.uint8).tobytes().decode()
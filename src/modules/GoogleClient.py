@@ -1,6 +1,14 @@
 import os
-import googlemaps
+
+# Shared across requests while the process (or warm Lambda container) lives
+_client = None
+
 
 class GoogleClient:
     def __init__(self):
-        self.client = googlemaps.Client(key=os.environ['API_KEY'])
+        global _client
+        if _client is None:
+            # googlemaps pulls in requests, so only import it once a client is needed
+            import googlemaps
+            _client = googlemaps.Client(key=os.environ['API_KEY'])
+        self.client = _client
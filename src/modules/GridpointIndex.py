@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import os
+import threading
+
+import numpy as np
+
+import src.constants as c
+
+logger = logging.getLogger(__name__)
+
+# One fixed-size record per quantized coordinate, sorted by key so lookups can binary search
+record_dtype = np.dtype([
+    ('key', '<i8'),
+    ('office', 'S4'),
+    ('grid_x', '<i4'),
+    ('grid_y', '<i4'),
+])
+
+
+class GridpointIndex:
+    """
+    Maps coordinates to NWS grid cells without calling /points.
+
+    The mapping is learned from /points responses and persisted to a memory-mapped file
+    of records keyed by coordinates quantized to `precision` degrees. The file is only
+    opened on first lookup so importing this module stays cheap.
+    """
+
+    def __init__(self, path=c.gridpoint_index_path, precision=c.gridpoint_index_precision,
+                 max_entries=c.gridpoint_index_max_entries):
+        self.path = path
+        self.precision = precision
+        self.max_entries = max_entries
+        self.lng_buckets = int(round(360 / precision)) + 1
+        self.records = None
+        self.loaded = False
+        # Learned since the last flush, key -> (office, grid_x, grid_y)
+        self.pending = {}
+        # Being written by flush_in_background
+        self.flushing = {}
+
+    def quantize(self, lat, lng):
+        """
+        Quantizes a coordinate to its integer index key
+
+        :param lat: latitude in degrees
+        :param lng: longitude in degrees
+
+        :return: int key
+        """
+        lat_bucket = int(round((lat + 90) / self.precision))
+        lng_bucket = int(round((lng + 180) / self.precision))
+        return lat_bucket * self.lng_buckets + lng_bucket
+
+    def load(self):
+        self.loaded = True
+        try:
+            self.records = np.memmap(self.path, dtype=record_dtype, mode='r')
+        except (OSError, ValueError):
+            # Missing or empty index, start from nothing
+            self.records = None
+
+    def lookup(self, lat, lng):
+        """
+        Looks up the grid cell for a coordinate
+
+        :param lat: latitude in degrees
+        :param lng: longitude in degrees
+
+        :return: tuple of (office, gridX, gridY), or None if the coordinate hasn't been seen
+        """
+        key = self.quantize(lat, lng)
+        if key in self.pending:
+            return self.pending[key]
+        if key in self.flushing:
+            return self.flushing[key]
+
+        if not self.loaded:
+            self.load()
+        # write() swaps in a new memmap from another thread, keep using the one looked up in
+        records = self.records
+        if records is None or not len(records):
+            return None
+
+        i = np.searchsorted(records['key'], key)
+        if i == len(records) or records['key'][i] != key:
+            return None
+
+        record = records[i]
+        return record['office'].decode(), int(record['grid_x']), int(record['grid_y'])
+
+    def add(self, lat, lng, grid_key):
+        """
+        Learns the grid cell of a coordinate from a /points response
+
+        :param lat: latitude in degrees
+        :param lng: longitude in degrees
+        :param grid_key: tuple of (office, gridX, gridY)
+        """
+        self.pending[self.quantize(lat, lng)] = grid_key
+
+    def clear(self):
+        """
+        Forgets every learned grid cell and deletes the on-disk index
+        """
+        self.pending = {}
+        self.flushing = {}
+        self.records = None
+        self.loaded = False
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def flush(self):
+        """
+        Merges learned entries into the on-disk index, see write
+        """
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        self.write(pending)
+
+    def flush_in_background(self):
+        """
+        Merges learned entries into the on-disk index on the running loop's default executor,
+        so the event loop isn't blocked. Until the write finishes lookups still see the entries.
+
+        :return: future of the write, or None if nothing was learned
+        """
+        if not self.pending:
+            return None
+        pending, self.pending = self.pending, {}
+        self.flushing.update(pending)
+
+        def finish(future):
+            for key in pending:
+                self.flushing.pop(key, None)
+            error = None if future.cancelled() else future.exception()
+            if error is not None:
+                logger.warning('Writing the gridpoint index failed: %r', error)
+                # Try again with the next flush
+                self.pending = {**pending, **self.pending}
+
+        future = asyncio.get_running_loop().run_in_executor(None, self.write, pending)
+        future.add_done_callback(finish)
+        return future
+
+    def write(self, pending):
+        """
+        Merges entries into the on-disk index. The current file is re-read under an exclusive lock,
+        so entries written by other processes (e.g. server.py workers) since this one loaded it are
+        kept, and it is replaced atomically so readers never see a partial write.
+
+        The index is kept to max_entries by dropping randomly chosen entries, existing ones first.
+
+        :param pending: dict of key -> (office, grid_x, grid_y)
+        """
+        import fcntl
+
+        new_records = np.empty(len(pending), dtype=record_dtype)
+        new_records['key'] = list(pending.keys())
+        new_records['office'] = [office.encode() for office, _, _ in pending.values()]
+        new_records['grid_x'] = [grid_x for _, grid_x, _ in pending.values()]
+        new_records['grid_y'] = [grid_y for _, _, grid_y in pending.values()]
+
+        with open(f'{self.path}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                current = np.fromfile(self.path, dtype=record_dtype)
+            except (OSError, ValueError):
+                current = np.empty(0, dtype=record_dtype)
+
+            # Learned entries come first so they win when de-duplicating
+            records = np.concatenate((new_records, current))
+            _, unique = np.unique(records['key'], return_index=True)
+            merged = records[unique]
+
+            excess = len(merged) - self.max_entries
+            if excess > 0:
+                # Drop random existing entries first, just learned ones are the likeliest to be looked up again
+                learned = np.isin(merged['key'], new_records['key'])
+                candidates = np.concatenate((np.random.permutation(np.flatnonzero(~learned)),
+                                             np.random.permutation(np.flatnonzero(learned))))
+                merged = np.delete(merged, candidates[:excess])
+
+            tmp_path = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            merged.tofile(tmp_path)
+            os.replace(tmp_path, self.path)
+
+        self.load()
+
+
+# Shared across warm invocations
+gridpoint_index = GridpointIndex()
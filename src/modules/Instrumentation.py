@@ -0,0 +1,103 @@
+import contextvars
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+
+import src.constants as c
+
+logger = logging.getLogger('whether')
+logger.setLevel(os.environ.get('LOG_LEVEL', c.log_level))
+
+# Metrics of the request being handled. Tasks created while handling it inherit the context.
+_current = contextvars.ContextVar('whether_request_metrics', default=None)
+
+
+class RequestMetrics:
+    """
+    Span durations and counters collected while handling one request
+    """
+
+    def __init__(self, sampled):
+        self.request_id = uuid.uuid4().hex[:12]
+        self.sampled = sampled
+        self.start = time.perf_counter()
+        # name -> [total seconds, count]
+        self.spans = defaultdict(lambda: [0.0, 0])
+        self.counters = defaultdict(int)
+
+    def summary(self):
+        return {
+            'request_id': self.request_id,
+            'total_ms': round((time.perf_counter() - self.start) * 1000, 1),
+            'spans': {name: {'ms': round(seconds * 1000, 1), 'count': count}
+                      for name, (seconds, count) in self.spans.items()},
+            'counters': dict(self.counters),
+        }
+
+
+def start_request():
+    """
+    Starts collecting metrics for a request in the current context
+
+    :return: RequestMetrics
+    """
+    metrics = RequestMetrics(sampled=random.random() < c.metrics_sample_rate)
+    _current.set(metrics)
+    return metrics
+
+
+def finish_request(**fields):
+    """
+    Logs the current request's metrics as one JSON line, if it was sampled
+
+    :param fields: extra fields for the summary, e.g. marker counts
+    """
+    metrics = _current.get()
+    if metrics is None:
+        return
+    _current.set(None)
+    if metrics.sampled and logger.isEnabledFor(logging.INFO):
+        summary = metrics.summary()
+        summary.update(fields)
+        logger.info('whether_request %s', json.dumps(summary))
+
+
+@contextmanager
+def span(name):
+    """
+    Times the block and adds it to the current request's span of that name.
+    Spans of the same name (e.g. each upstream call to a host) are summed.
+    """
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        entry = metrics.spans[name]
+        entry[0] += time.perf_counter() - start
+        entry[1] += 1
+
+
+def count(name, value=1):
+    """
+    Adds to one of the current request's counters
+    """
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.counters[name] += value
+
+
+async def timed(name, awaitable):
+    """
+    Awaits `awaitable` inside a span, for stages that run as their own task
+    """
+    with span(name):
+        return await awaitable
@@ -0,0 +1,52 @@
+class Marker:
+    """
+    A point along the route the weather is looked up at.
+
+    Markers pass through every stage of the pipeline, so they are kept as compact slotted
+    records and only turned into dicts when the response is serialized, see to_dict.
+    weather_data references the matched period of the cached forecast rather than copying it.
+    """
+
+    __slots__ = ('lat', 'lng', 'distance', 'arrival_time', 'address', 'weather_data', 'weather_status')
+
+    def __init__(self, lat, lng, distance=None):
+        self.lat = lat
+        self.lng = lng
+        # Miles along the route
+        self.distance = distance
+        # Minutes after departure
+        self.arrival_time = None
+        self.address = None
+        self.weather_data = None
+        # 'stale', 'pending' or 'unavailable' when the forecast missed the deadline or failed,
+        # see WhetherAlgorithm.fallback_forecast
+        self.weather_status = None
+
+    def __repr__(self):
+        return f'Marker({self.lat}, {self.lng}, distance={self.distance}, arrival_time={self.arrival_time})'
+
+    def to_dict(self, period_fields=None, coordinates=True):
+        """
+        Serializable form of the marker
+
+        :param period_fields: forecast period fields to include in weather_data, or None for all of them
+        :param coordinates: include lat and lng, left out when they are sent as a polyline
+
+        :return: dict
+        """
+        marker = {}
+        if coordinates:
+            marker['lat'] = self.lat
+            marker['lng'] = self.lng
+        marker['distance'] = self.distance
+        marker['arrival_time'] = self.arrival_time
+        marker['address'] = self.address
+
+        if self.weather_data is not None:
+            if period_fields is None:
+                marker['weather_data'] = self.weather_data
+            else:
+                marker['weather_data'] = {field: self.weather_data.get(field) for field in period_fields}
+        if self.weather_status is not None:
+            marker['weather_status'] = self.weather_status
+        return marker
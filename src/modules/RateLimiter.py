@@ -0,0 +1,72 @@
+import asyncio
+import time
+
+import src.constants as c
+from src.modules.Instrumentation import count
+
+# host -> TokenBucket, shared by every request in the process
+_buckets = {}
+
+
+class TokenBucket:
+    """
+    Async token bucket allowing `rate` requests per second on average and bursts of up to `burst`.
+
+    Callers reserve a token up front, letting the count go negative, and sleep until it would
+    have been earned, so waiters are served in arrival order without a lock. Tokens are refilled
+    from a monotonic clock rather than the event loop's, so one bucket can serve any loop.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """
+        Waits in line until a request may be sent. There is no timeout, waiting for a token isn't a
+        failed request; a request's deadline_ms bounds it by cancelling the wait.
+        """
+        self.refill()
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return
+
+        count('rate_limited')
+        try:
+            await asyncio.sleep(-self.tokens / self.rate)
+        except asyncio.CancelledError:
+            # Give the reservation back to whoever is queued behind
+            self.tokens += 1
+            raise
+
+    def pause(self, seconds):
+        """
+        Holds back every request for `seconds`, e.g. when the host answers 429 with a Retry-After.
+        Capped at retry_backoff_max so one response can't stall the process for long.
+
+        :param seconds: how long to wait before the next request
+        """
+        self.refill()
+        self.tokens = min(self.tokens, 0) - min(seconds, c.retry_backoff_max) * self.rate
+
+
+def get_rate_limiter(host):
+    """
+    Returns the process-wide bucket for a host, see constants.rate_limits
+
+    :param host: url host
+
+    :return: TokenBucket, or None if the host isn't rate limited
+    """
+    bucket = _buckets.get(host)
+    if bucket is None and host in c.rate_limits:
+        rate, burst = c.rate_limits[host]
+        bucket = _buckets[host] = TokenBucket(rate, burst)
+    return bucket
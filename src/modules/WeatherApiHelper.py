@@ -1,9 +1,10 @@
 import asyncio
 import datetime
 import logging
-import aiohttp
 from dateutil.parser import parse
 
+from src.modules.AsyncHelper import AsyncHelper
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
@@ -13,27 +14,22 @@ class WeatherApiHelper:
     def __init__(self):
         self.BASE_URL = 'https://api.weather.gov/points/{lat},{lng}/forecast/hourly'
 
-    async def get_response(self, session, marker):
-        url = self.BASE_URL.format(
-            lat=marker['lat'],
-            lng=marker['lng']
-        )
-        async with session.get(url) as resp:
-            data = await resp.json()
-        return data
-
     async def download_one(self, marker):
         base_headers = {
             'accept': 'application/geo+json',
             'user-agent': 'locknesssoftware/whether-application'
         }
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(verify_ssl=False), headers=base_headers) as session:
-            data = await self.get_response(session, marker)
-        return data, marker
+        url = self.BASE_URL.format(
+            lat=marker.lat,
+            lng=marker.lng
+        )
+        # Reuse the pooled per-host session rather than opening a new connection per marker
+        async_helper = AsyncHelper([(url, marker)], base_headers)
+        return await async_helper.get_one((url, marker))
 
     def get_weather_at_markers(self, markers):
-        loop = asyncio.get_event_loop()
-        to_do = [self.download_one(marker) for marker in markers]
+        loop = AsyncHelper.get_loop()
+        to_do = [loop.create_task(self.download_one(marker)) for marker in markers]
         wait_coro = asyncio.wait(to_do)
         res, _ = loop.run_until_complete(wait_coro)
         now = datetime.datetime.now()
@@ -42,7 +38,7 @@ class WeatherApiHelper:
         for response in res:
             weather_response, marker = response.result()
             # marker = response.result()[1]
-            utc_time_from_now = now + datetime.timedelta(minutes=marker['arrival_time'])
+            utc_time_from_now = now + datetime.timedelta(minutes=marker.arrival_time)
 
             for period in weather_response['properties']['periods']:
                 period_start_time = parse(period['startTime']).replace(tzinfo=None)
@@ -50,7 +46,7 @@ class WeatherApiHelper:
 
                 # If the utc time at the marker is within the period, add the weather data to the marker
                 if period_start_time <= utc_time_from_now < period_end_time:
-                    marker['weather_data'] = period
+                    marker.weather_data = period
                     markers.append(marker)
                     # Jump to next marker
                     break
@@ -1,23 +1,30 @@
+import asyncio
 import datetime
-import math
+from collections import defaultdict
 
-import googlemaps
 import numpy as np
-from dateutil.parser import parse
-from pytz import timezone
 
 import src.constants as c
 from src.modules.AsyncHelper import AsyncHelper
+from src.modules.DirectionsCache import get_directions_cache
+from src.modules.ForecastCache import ForecastCache, IndexedForecast, forecast_cache, period_values
+from src.modules.Geometry import decode_polylines, equidistant_markers, route_distances, travel_time_markers
 from src.modules.GoogleClient import GoogleClient
+from src.modules.GridpointIndex import gridpoint_index
+from src.modules.Instrumentation import count, logger
+from src.modules.Marker import Marker
 
 
 class WhetherAlgorithm:
-    def __init__(self):
-        self.googlemaps_client = GoogleClient().client
+    @property
+    def googlemaps_client(self):
+        # Created on first use, cached directions never need it
+        return GoogleClient().client
 
     def get_directions(self, params, waypoints=None):
         """
         Queries the googlemaps api for directions between an origin and destination.
+        Results are cached per departure time bucket, see DirectionsCache.
 
         :param params: TODO
         :param waypoints: points to alter route
@@ -28,189 +35,112 @@ class WhetherAlgorithm:
         if waypoints is not None:
             optimize_waypoints = False
 
-        result = self.googlemaps_client.directions(params['origin'],
-                                                   params['destination'],
-                                                   mode='driving',
-                                                   departure_time=datetime.datetime.now(),
-                                                   waypoints=waypoints,
-                                                   optimize_waypoints=optimize_waypoints)
-        return result
+        departure_time = datetime.datetime.now()
+
+        def call():
+            return self.googlemaps_client.directions(params['origin'],
+                                                     params['destination'],
+                                                     mode='driving',
+                                                     departure_time=departure_time,
+                                                     waypoints=waypoints,
+                                                     optimize_waypoints=optimize_waypoints)
+
+        return get_directions_cache().get_or_call('directions',
+                                                  departure_time,
+                                                  (params['origin'], params['destination'], waypoints),
+                                                  call)
 
     @staticmethod
     def extract_polylines(directions_result):
         """
-        Takes polyline points and converts to list of lat/lng dicts
+        Decodes the polylines of every step of every leg of the first route into one array
 
-        :param directions_result: TODO
+        :param directions_result: list of routes from get_directions
 
-        :return: list of dicts with lat/lng keys
+        :return: (N, 2) float array of lat/lng
         """
-        all_points = []
-
-        for step in directions_result[0]['legs'][0]['steps']:
-            polyline_points = step['polyline']['points']
-            decoded_points = googlemaps.convert.decode_polyline(polyline_points)
-
-            # need to keep first point if start of list, otherwise first point is a duplicate
-            if not all_points:
-                all_points = decoded_points
-            else:
-                all_points.extend(decoded_points[1:])
+        encoded_polylines = [step['polyline']['points']
+                             for leg in directions_result[0]['legs']
+                             for step in leg['steps']]
 
-        return all_points
+        return decode_polylines(encoded_polylines)
 
-    def get_equidistant_markers_from_polyline_points(self, points, distance):
+    @staticmethod
+    def get_equidistant_markers_from_polyline_points(points, distance):
         """
         Given set of points, returns set of points that are evenly spaced along
-        said points.
-
-        Drops last point if close enough to destination.
-
-        Order is guaranteed unless if statement is entered. TODO: fix that.
+        said points, in route order. See Geometry.equidistant_markers.
 
-        Essentially, builds array of distances between points, and uses a binary search to determine
-        where to insert along the array (numpy.searchsorted). Then uses remainder to determine how far
-        along a polyline to travel for each evenly spaced point.
-
-        :param points: list of dict coords of lat/long
-        :param distance: distance between points, in km
-        :return: list of dict of coords lat/long
+        :param points: (N, 2) float array of lat/lng
+        :param distance: distance between points, in miles
+        :return: list of Markers
         """
-        # from dict to array
-        points = np.array([list(d.values()) for d in points])
-
-        # build array of sequential points
-        sequ_points = np.empty((len(points) - 1, 4))
-        sequ_points[:, :2] = points[:-1]
-        sequ_points[:, 2:] = points[1:]
-
-        # calculate distances between points, and figure out remainders
-        distances = np.apply_along_axis(WhetherAlgorithm.haversine, 1, sequ_points)
-        mods = (distances.cumsum() % distance)
-
-        # get steps: start at distance, with step of distance until end
-        steps = np.arange(distance, distances.sum(), distance)
-
-        # locations where steps insert
-        inserts = np.searchsorted(distances.cumsum(), steps) - 1
-
-        # check distance between last insert and destination
-        # ignores remainder, so it's an approximation
-        distance_bewteen_last = distances[inserts[-1] + 1:].sum()
-
-        # if small enough distance, drop last step and redo
-        if distance_bewteen_last < distance / 2:
-            steps = steps[:-1]
-            inserts = np.searchsorted(distances.cumsum(), steps) - 1
-
-        # look for duplicates
-        uns, idxs, cnts = np.unique(inserts, return_index=True, return_counts=True)
-
-        # append remainders to tweeners in order to np apply
-        tweeners = sequ_points[uns + 1]
-        remainders = (distance - mods[uns])
-
-        # look for and process duplicates
-        m_dup = (cnts > 1).nonzero()[0]
-
-        # TODO: the points generated here don't look optimal, figure it out
-        # only called if len of polyline is greater than requested distance between points
-        if len(m_dup) > 0:
-            dups, count = uns[m_dup], cnts[m_dup]-1
+        even_points, distances = equidistant_markers(points, distance, return_distances=True)
 
-            dups = np.repeat(dups, count)
-            ins = np.repeat(idxs[m_dup]+1, count)
-
-            ar1 = lambda x: np.arange(start=1, stop=x+1)
-            count = np.concatenate(np.array(list(map(ar1, count))))
-
-            more_tweeners = sequ_points[dups + 1]
-            more_remainders = ((distance * count) + mods[dups])
-
-            # combine
-            tweeners = np.vstack((tweeners, more_tweeners))
-            remainders = np.hstack((remainders, more_remainders))
-
-        merged = np.concatenate((tweeners, remainders[:, np.newaxis]), axis=1)
-
-        # points
-        even_points = np.apply_along_axis(WhetherAlgorithm.move_towards, 1, merged)
-
-        # back into dict
-        list_dict_even_points = [{'lat': lat, 'lng': lng} for lat, lng in even_points]
-
-        # add first and last points
-        list_dict_even_points = [{'lat': points[0][0], 'lng': points[0][1]}] + \
-                                list_dict_even_points + \
-                                [{'lat': points[-1][0], 'lng': points[-1][1]}]
-
-        return list_dict_even_points
+        return [Marker(lat, lng, marker_distance)
+                for (lat, lng), marker_distance in zip(even_points.tolist(), distances.tolist())]
 
     @staticmethod
-    def move_towards(coords_dist):
+    def get_travel_time_markers(directions_result, interval):
         """
-        Moves along a line segment by the specified distance
+        Places markers `interval` minutes of driving apart using the step durations of the
+        first route, then drops markers sharing a grid cell, see Geometry.travel_time_markers
+        and dedupe_grid_cells.
 
-        :param coords_dist: iterable of [lat1, lon1, lat2, lon2, distance]
-        :return: new coordinate
+        :param directions_result: list of routes from get_directions
+        :param interval: driving time between markers, in minutes
+        :return: list of Markers
         """
-        # expand
-        lat1, lon1, lat2, lon2, distance = coords_dist
-
-        # Convert degrees to radians
-        d_lon = math.radians(lon2 - lon1)
-        lat1 = math.radians(lat1)
-        lon1 = math.radians(lon1)
-        lat2 = math.radians(lat2)
+        steps = [step for leg in directions_result[0]['legs'] for step in leg['steps']]
+        points, step_ends = decode_polylines([step['polyline']['points'] for step in steps], return_step_ends=True)
+        step_seconds = [step['duration']['value'] for step in steps]
 
-        # Find the bearing from point1 to point2
-        bearing = math.atan2(math.sin(d_lon) * math.cos(lat2),
-                             math.cos(lat1) * math.sin(lat2) -
-                             math.sin(lat1) * math.cos(lat2) *
-                             math.cos(d_lon))
-
-        # Earth's radius in miles
-        ang_dist = distance / 3959
-
-        # Calculate the destination point, given the source and bearing
-        lat2 = math.asin(math.sin(lat1) * math.cos(ang_dist) +
-                         math.cos(lat1) * math.sin(ang_dist) *
-                         math.cos(bearing))
-
-        lon2 = lon1 + math.atan2(math.sin(bearing) * math.sin(ang_dist) *
-                                 math.cos(lat1),
-                                 math.cos(ang_dist) - math.sin(lat1) *
-                                 math.sin(lat2))
-
-        if math.isnan(lat2) or math.isnan(lon2):
-            return None
-
-        return np.array([math.degrees(lat2), math.degrees(lon2)])
+        timed_points, distances = travel_time_markers(points, step_ends, step_seconds, interval, return_distances=True)
+        markers = [Marker(lat, lng, marker_distance)
+                   for (lat, lng), marker_distance in zip(timed_points.tolist(), distances.tolist())]
+        return WhetherAlgorithm.dedupe_grid_cells(markers)
 
     @staticmethod
-    def haversine(coords):
+    def grid_cell(marker):
         """
-        Calculate the great circle distance between two points
-        on the earth (specified in decimal degrees)
+        Approximate grid cell a marker is in, by snapping to a grid_cell_degrees wide lat/lng grid.
+        Always snapped rather than taken from the gridpoint index, so the same markers are kept
+        whether or not the index has seen their cells.
 
-        :param coords: iterable of [lat1, lon1, lat2, lon2]
-        :return: distance in miles
+        :param marker: weather location
+        :return: tuple of snapped lat and lng indexes
         """
-        lat1, lon1, lat2, lon2 = coords
-
-        # convert decimal degrees to radians
-        lon1, lat1, lon2, lat2 = map(math.radians, [lon1, lat1, lon2, lat2])
+        return (round(marker.lat / c.grid_cell_degrees),
+                round(marker.lng * np.cos(np.radians(marker.lat)) / c.grid_cell_degrees))
 
-        # haversine formula
-        dlon = lon2 - lon1
-        dlat = lat2 - lat1
-        a = math.sin(dlat / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2) ** 2
-        c = 2 * math.asin(math.sqrt(a))
-
-        # Radius of earth in kilometers is 3,959 miles
-        miles = 3959 * c
+    @staticmethod
+    def dedupe_grid_cells(markers):
+        """
+        Drops markers in a grid cell an earlier marker is already in, as they would most likely get the same
+        forecast, see grid_cell.
+        The origin and destination are always kept; the destination replaces the marker before it
+        if they share a cell.
 
-        return miles
+        :param markers: weather locations in route order
+        :return: list of markers
+        """
+        if len(markers) < 3:
+            return markers
+
+        kept = [markers[0]]
+        seen = {WhetherAlgorithm.grid_cell(markers[0])}
+        for marker in markers[1:-1]:
+            cell = WhetherAlgorithm.grid_cell(marker)
+            if cell not in seen:
+                seen.add(cell)
+                kept.append(marker)
+
+        destination = markers[-1]
+        if len(kept) > 1 and WhetherAlgorithm.grid_cell(kept[-1]) == WhetherAlgorithm.grid_cell(destination):
+            kept.pop()
+        kept.append(destination)
+        count('markers_deduped', len(markers) - len(kept))
+        return kept
 
     @staticmethod
     def create_waypoint_string(waypoints):
@@ -221,7 +151,7 @@ class WhetherAlgorithm:
 
         :return: list of waypoint strings
         """
-        waypoints_joined = [f'{waypoint["lat"]},{waypoint["lng"]}' for waypoint in waypoints]
+        waypoints_joined = [f'{waypoint.lat},{waypoint.lng}' for waypoint in waypoints]
 
         return waypoints_joined
 
@@ -241,8 +171,8 @@ class WhetherAlgorithm:
             destination = waypoints.pop(-1)
             joined_waypoints = '|'.join(self.create_waypoint_string(waypoints))
 
-            url = c.directions_api_base_url.format(origin=f'{origin["lat"]},{origin["lng"]}',
-                                                   destination=f'{destination["lat"]},{destination["lng"]}',
+            url = c.directions_api_base_url.format(origin=f'{origin.lat},{origin.lng}',
+                                                   destination=f'{destination.lat},{destination.lng}',
                                                    waypoints=joined_waypoints,
                                                    api_key=c.api_key)
 
@@ -273,8 +203,18 @@ class WhetherAlgorithm:
 
         return chunks
 
-    # TODO - Make this just handle the async responses and assign arrival times
     def get_waypoint_directions(self, equidistant_markers):
+        """
+        Blocking wrapper around fetch_waypoint_directions
+
+        :param equidistant_markers: markers to route through
+
+        :return: markers with arrival_time in minutes and address
+        """
+        return AsyncHelper.get_loop().run_until_complete(self.fetch_waypoint_directions(equidistant_markers))
+
+    # TODO - Make this just handle the async responses and assign arrival times
+    async def fetch_waypoint_directions(self, equidistant_markers):
         # Set the origin of the directions as the first waypoint so it doesn't calculate a leg of 1 minute
         # Remove that marker so it's not repeated
         # origin = equidistant_markers.pop(0)
@@ -291,27 +231,22 @@ class WhetherAlgorithm:
         chunks = self.split_up_waypoints(equidistant_markers)
         waypoint_urls = self.create_waypoint_urls(chunks)
         async_session = AsyncHelper(waypoint_urls, None)
-        results = async_session.async_all()
-        # TODO - Order the results returns from async
-        # TODO - Maybe pass an index along with the chunks?
-        # TODO - OR Just keep track of which marker is which chunk (marker might already be in the async results)
+        results = await async_session.wait_all()
 
-        # Get the results in order, and then append the legs to one big list
+        # Results come back in chunk order, append the legs to one big list
         leg_list = []
-        for chunk in chunks:
-            for result in results:
-                if result.result()[1][0] == chunk[0]:
-                    # Then this is the result corresponding to the chunk
-                    leg_list += (result.result()[0]['routes'][0]['legs'])
-                    # results.remove(result)
+        for result, _ in results:
+            if result is None or not result.get('routes'):
+                raise ValueError('Waypoint directions request failed')
+            leg_list += result['routes'][0]['legs']
 
         # Initialize total travel minutes
         total_mins = 0
 
         # Set arrival time of first marker to 0 minutes
         # Set address of first marker to the first waypoint's start address
-        equidistant_markers[0]['arrival_time'] = 0
-        equidistant_markers[0]['address'] = leg_list[0]['start_address']
+        equidistant_markers[0].arrival_time = 0
+        equidistant_markers[0].address = leg_list[0]['start_address']
 
         i = 1  # Index starts at 1 because the first marker has default arrival time of 0 mins
 
@@ -321,58 +256,370 @@ class WhetherAlgorithm:
             total_mins += (leg['duration']['value'] / 60)
 
             # Set the arrival time of the next marker to the total_mins using arrival time of current waypoint
-            equidistant_markers[i]['arrival_time'] = total_mins
+            equidistant_markers[i].arrival_time = total_mins
 
             # Set the address of the next marker as the end_address of the current waypoint
-            equidistant_markers[i]['address'] = leg['end_address']
+            equidistant_markers[i].address = leg['end_address']
             i += 1
 
         return equidistant_markers
 
     @staticmethod
-    def create_weather_api_urls(markers):
+    def estimate_arrival_times(directions_result, equidistant_markers):
         """
-        Takes list of markers and generates urls
+        Estimates the arrival time at each marker from the original directions, without another
+        Directions round trip. Step durations are accumulated and interpolated linearly by
+        distance along the route.
+
+        Only the origin and destination get an address.
 
-        :param markers: TODO
+        :param directions_result: list of routes from get_directions
+        :param equidistant_markers: markers with their distance along the route
 
-        :return: list of url markers
+        :return: markers with arrival_time in minutes and address
         """
-        url_marker_list = []
-        for marker in markers:
-            url_marker_tuple = (c.weather_api_base_url.format(lat=marker['lat'], lng=marker['lng']), marker)
-            url_marker_list.append(url_marker_tuple)
+        legs = directions_result[0]['legs']
+        steps = [step for leg in legs for step in leg['steps']]
+
+        points, step_ends = decode_polylines([step['polyline']['points'] for step in steps],
+                                             return_step_ends=True)
+        cumulative = route_distances(points)
+
+        # Distance and elapsed minutes at the start of the route and at the end of each step
+        step_distances = np.concatenate(([0.0], cumulative[step_ends]))
+        step_minutes = np.concatenate(([0.0], np.cumsum([step['duration']['value'] for step in steps]) / 60))
+
+        marker_distances = [marker.distance for marker in equidistant_markers]
+        arrival_times = np.interp(marker_distances, step_distances, step_minutes)
 
-        return url_marker_list
+        for marker, arrival_time in zip(equidistant_markers, arrival_times.tolist()):
+            marker.arrival_time = arrival_time
+            marker.address = None
 
-    def get_weather_at_markers(self, markers):
+        equidistant_markers[0].address = legs[0]['start_address']
+        equidistant_markers[-1].address = legs[-1]['end_address']
+
+        return equidistant_markers
+
+    def get_forecasts(self, markers, deadline_ms=None):
         """
-        Gets the weather at each marker
+        Blocking wrapper around fetch_forecasts
 
         :param markers: weather locations
+        :param deadline_ms: milliseconds to wait for forecasts, or None to wait for every forecast
 
-        :return: list of weather data at each location
+        :return: list of IndexedForecasts in marker order
+        """
+        loop = AsyncHelper.get_loop()
+        deadline = None if deadline_ms is None else loop.time() + deadline_ms / 1000
+        return loop.run_until_complete(self.fetch_forecasts(markers, deadline))
+
+    @staticmethod
+    async def resolve_grid_cell(marker):
+        """
+        Resolves a marker to its NWS grid cell, from the local gridpoint index when the
+        coordinate has been seen before and from /points otherwise
+
+        :param marker: weather location
+
+        :return: tuple of (grid cell key, forecast url), (None, None) if it couldn't be resolved
+        """
+        key = gridpoint_index.lookup(marker.lat, marker.lng)
+        if key is not None:
+            count('gridpoint_index_hits')
+            return key, c.gridpoint_forecast_url.format(office=key[0], grid_x=key[1], grid_y=key[2])
+
+        count('gridpoint_index_misses')
+        url = c.points_api_base_url.format(lat=marker.lat, lng=marker.lng)
+        points_session = AsyncHelper([(url, None)], c.weather_api_base_headers)
+        [(points_response, _)] = await points_session.wait_all()
+        properties = points_response and points_response.get('properties')
+
+        # Points outside NWS coverage come back without properties
+        if not properties or not properties.get('forecastHourly'):
+            return None, None
+
+        key = ForecastCache.grid_key(properties)
+        gridpoint_index.add(marker.lat, marker.lng, key)
+        return key, properties['forecastHourly']
+
+    @staticmethod
+    async def fetch_cell_forecast(key, url):
+        """
+        Gets the hourly forecast of a grid cell, from the forecast cache while it is fresh
+
+        :param key: grid cell key
+        :param url: forecast url
+
+        :return: IndexedForecast, or None if the request failed
+        """
+        forecast = forecast_cache.get(key)
+        if forecast is not None:
+            count('forecast_cache_hits')
+            return forecast
+        count('forecast_cache_misses')
+
+        forecast_session = AsyncHelper([(url, key)], c.weather_api_base_headers, include_meta=True)
+        [(response, _, meta)] = await forecast_session.wait_all()
+        if response is None or 'properties' not in response:
+            return None
+
+        forecast = IndexedForecast(response)
+        forecast_cache.put(key, forecast, ForecastCache.get_expiry(response, meta['expires']), meta['size'])
+        return forecast
+
+    async def fetch_marker_forecast(self, marker, cell_tasks):
+        key, url = await self.resolve_grid_cell(marker)
+        if key is None:
+            return None
+
+        # Markers sharing a grid cell share one fetch
+        if key not in cell_tasks:
+            cell_tasks[key] = asyncio.ensure_future(self.fetch_cell_forecast(key, url))
+        # Shielded so one cancelled marker doesn't cancel the fetch for the others
+        return await asyncio.shield(cell_tasks[key])
+
+    def create_forecast_tasks(self, markers, cell_tasks):
+        """
+        Starts getting the hourly forecast for each marker. Markers are resolved to their NWS grid cell
+        first, so each cell is fetched at most once per request and cached across requests.
+
+        :param markers: weather locations
+        :param cell_tasks: dict the per grid cell fetches are added to, so they can be cancelled
+
+        :return: list of tasks resolving to an IndexedForecast or None, in marker order
         """
-        now = datetime.datetime.now(timezone('UTC'))
-        url_marker_list = self.create_weather_api_urls(markers)
-        async_session = AsyncHelper(url_marker_list, c.weather_api_base_headers)
-        result = async_session.async_all()
-        markers = []
-
-        for response in result:
-            weather_response, marker = response.result()
-            print("WEATHER RESPONSE: ", weather_response)
-            print("MARKERS: ", marker)
-            utc_time_from_now = now + datetime.timedelta(minutes=marker['arrival_time'])
-
-            # TODO - Just round up/down to find the range first, then get that period from the data
-            for period in weather_response['properties']['periods']:
-                period_start_time = parse(period['startTime'])
-                period_end_time = parse(period['endTime'])
-
-                # If the utc time at the marker is within the period, add the weather data to the marker
-                if period_start_time <= utc_time_from_now < period_end_time:
-                    marker['weather_data'] = period
-                    markers.append(marker)
-                    # Jump to next marker
+        return [asyncio.ensure_future(self.fetch_marker_forecast(marker, cell_tasks)) for marker in markers]
+
+    @staticmethod
+    def fallback_forecast(marker, missing_status='pending'):
+        """
+        For a marker whose forecast didn't arrive in time or failed, returns the last cached forecast of its
+        grid cell even if it has expired. Marks the marker's weather_status as 'stale', or `missing_status`
+        if there is none.
+
+        :param marker: weather location
+        :param missing_status: 'pending' when the forecast missed the deadline, 'unavailable' when it failed
+
+        :return: IndexedForecast or None
+        """
+        key = gridpoint_index.lookup(marker.lat, marker.lng)
+        forecast = forecast_cache.get_stale(key) if key is not None else None
+        marker.weather_status = 'stale' if forecast is not None else missing_status
+        count(f'markers_{marker.weather_status}')
+        return forecast
+
+    @staticmethod
+    async def cancel_tasks(tasks):
+        for task in tasks:
+            task.cancel()
+        # Let them finish cancelling so nothing is left suspended on the shared loop
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    @staticmethod
+    def get_timeout(deadline):
+        if deadline is None:
+            return None
+        return max(0, deadline - asyncio.get_running_loop().time())
+
+    async def fetch_forecasts(self, markers, deadline=None):
+        """
+        Gets the hourly forecast for each marker, see create_forecast_tasks. Requests still outstanding
+        at the deadline are cancelled and those markers, like those whose request failed, get a fallback_forecast.
+
+        :param markers: weather locations
+        :param deadline: event loop time to stop waiting at, or None to wait for every forecast
+
+        :return: list of IndexedForecasts in marker order, None where there is no forecast for the marker
+        """
+        cell_tasks = {}
+        forecast_tasks = self.create_forecast_tasks(markers, cell_tasks)
+        try:
+            if forecast_tasks:
+                await asyncio.wait(forecast_tasks, timeout=self.get_timeout(deadline))
+
+            forecasts = []
+            for marker, task in zip(markers, forecast_tasks):
+                if not task.done():
+                    forecasts.append(self.fallback_forecast(marker))
+                else:
+                    forecast = task.result()
+                    forecasts.append(forecast if forecast is not None else self.fallback_forecast(marker, 'unavailable'))
+            return forecasts
+        finally:
+            await self.cancel_tasks(forecast_tasks + list(cell_tasks.values()))
+            gridpoint_index.flush_in_background()
+
+    async def iter_forecasts(self, markers, forecast_tasks, cell_tasks, deadline=None):
+        """
+        Yields each marker's forecast as soon as it resolves. Markers still outstanding at the deadline
+        are cancelled and yielded last with a fallback_forecast, as are markers whose request failed.
+
+        :param markers: weather locations
+        :param forecast_tasks: tasks from create_forecast_tasks
+        :param cell_tasks: cell_tasks given to create_forecast_tasks
+        :param deadline: event loop time to stop waiting at, or None to wait for every forecast
+
+        :return: async iterator of (marker index, IndexedForecast or None)
+        """
+        task_indexes = {task: i for i, task in enumerate(forecast_tasks)}
+        pending = set(forecast_tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=self.get_timeout(deadline),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if not done:
                     break
+                for task in done:
+                    i, forecast = task_indexes[task], task.result()
+                    yield i, forecast if forecast is not None else self.fallback_forecast(markers[i], 'unavailable')
+
+            await self.cancel_tasks(forecast_tasks + list(cell_tasks.values()))
+            for i in sorted(task_indexes[task] for task in pending):
+                yield i, self.fallback_forecast(markers[i])
+        finally:
+            await self.cancel_tasks(forecast_tasks + list(cell_tasks.values()))
+            gridpoint_index.flush_in_background()
+
+    def get_weather_at_markers(self, markers, deadline_ms=None):
+        """
+        Gets the weather at each marker. With a deadline, markers whose forecast hasn't arrived
+        in time get the stale cached forecast or none, see fallback_forecast.
+
+        :param markers: weather locations
+        :param deadline_ms: milliseconds to wait for forecasts, or None to wait for every forecast
+
+        :return: list of weather data at each location
+        """
+        return self.match_weather_periods(markers, self.get_forecasts(markers, deadline_ms))
+
+    @staticmethod
+    def match_weather_periods(markers, forecasts):
+        """
+        Attaches the forecast period each marker will be reached in as its weather_data
+
+        :param markers: weather locations with arrival_time
+        :param forecasts: IndexedForecast for each marker, from fetch_forecasts
+
+        :return: list of markers with weather data
+        """
+        now = datetime.datetime.now(datetime.timezone.utc).timestamp()
+        weather_markers = []
+
+        for marker, forecast in zip(markers, forecasts):
+            logger.debug('Weather response: %s', forecast and forecast.response)
+            logger.debug('Marker: %s', marker)
+            if WhetherAlgorithm.match_weather_period(marker, forecast, now):
+                weather_markers.append(marker)
+
+        return weather_markers
+
+    @staticmethod
+    def match_weather_period(marker, forecast, now):
+        """
+        Attaches the forecast period the marker will be reached in as its weather_data
+
+        :param marker: weather location with arrival_time
+        :param forecast: IndexedForecast for the marker, or None
+        :param now: departure time as epoch seconds
+
+        :return: True if a period was found
+        """
+        if forecast is None:
+            return False
+        utc_time_from_now = now + marker.arrival_time * 60
+
+        # Binary search the forecast's parsed periods for the one the marker is reached in
+        i = int(forecast.find_periods(utc_time_from_now))
+        if i < 0:
+            return False
+        marker.weather_data = forecast.periods[i]
+        return True
+
+    @staticmethod
+    def evaluate_departures(markers, forecasts, offsets, now):
+        """
+        Matches the forecast period of every marker for every departure time at once. Arrival times
+        are taken as the same offsets from any departure, traffic isn't re-estimated per departure.
+
+        :param markers: weather locations with arrival_time
+        :param forecasts: IndexedForecast or None for each marker, from fetch_forecasts
+        :param offsets: departure times in minutes from now
+        :param now: current time as epoch seconds
+
+        :return: tuple of (departure x marker array of period indexes, -1 where there is none,
+                 dict of period_values name -> departure x marker float array, nan where there is none)
+        """
+        offsets = np.asarray(offsets, dtype=np.float64)
+        arrival_times = np.array([marker.arrival_time for marker in markers], dtype=np.float64)
+        times = now + (offsets[:, None] + arrival_times[None, :]) * 60
+
+        period_indexes = np.full(times.shape, -1)
+        values = {name: np.full(times.shape, np.nan) for name in period_values}
+
+        # Markers in the same grid cell share a forecast, look up all of their times in one go
+        columns = defaultdict(list)
+        for j, forecast in enumerate(forecasts):
+            if forecast is not None and len(forecast.periods):
+                columns[id(forecast)].append(j)
+
+        for marker_columns in columns.values():
+            forecast = forecasts[marker_columns[0]]
+            indexes = forecast.find_periods(times[:, marker_columns])
+            found = indexes >= 0
+            period_indexes[:, marker_columns] = indexes
+            for name, marker_values in values.items():
+                marker_values[:, marker_columns] = np.where(found, forecast.get_values(name)[indexes], np.nan)
+
+        return period_indexes, values
+
+    @staticmethod
+    def summarize_departures(offsets, now, period_indexes, values):
+        """
+        Summarizes the weather along the route for each departure time, see evaluate_departures
+
+        :return: list of dict per departure, None for values no marker has
+        """
+        def to_list(array):
+            return [None if np.isnan(value) else value for value in array.tolist()]
+
+        # fmax/fmin skip nan without warning about departures no marker has a value for
+        columns = {
+            'markers_covered': (period_indexes >= 0).sum(axis=1).tolist(),
+            'max_precipitation_probability': to_list(np.fmax.reduce(values['precipitation_probability'], axis=1)),
+            'max_wind_speed': to_list(np.fmax.reduce(values['wind_speed'], axis=1)),
+            'min_temperature': to_list(np.fmin.reduce(values['temperature'], axis=1)),
+            'max_temperature': to_list(np.fmax.reduce(values['temperature'], axis=1)),
+        }
+
+        departures = []
+        for i, offset in enumerate(offsets):
+            departure_time = datetime.datetime.fromtimestamp(now + offset * 60, datetime.timezone.utc)
+            departure = {'offset': offset, 'departure_time': departure_time.isoformat()}
+            departure.update({name: column[i] for name, column in columns.items()})
+            departures.append(departure)
+        return departures
+
+    @staticmethod
+    def best_departure(departures):
+        """
+        Picks the departure with the most markers covered by a forecast, so departures running past the
+        forecast horizon can't win on less data, then the lowest chance of precipitation along the route,
+        then the least wind. Unknown values rank after any known one.
+
+        :param departures: from summarize_departures
+
+        :return: index of the departure, or None if no departure has any forecast
+        """
+        def rank(i):
+            departure = departures[i]
+            precipitation = departure['max_precipitation_probability']
+            wind = departure['max_wind_speed']
+            return (-departure['markers_covered'],
+                    precipitation is None, precipitation or 0,
+                    wind is None, wind or 0)
+
+        covered = [i for i, departure in enumerate(departures) if departure['markers_covered']]
+        if not covered:
+            return None
+        return min(covered, key=rank)